@@ -1,51 +1,415 @@
-from flask import Flask, jsonify, abort, request
+import os
+import hashlib
+from datetime import date
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, abort, request
+from flask.json import JSONEncoder as BaseJSONEncoder
 from flask_cors import CORS
-from models import setup_db, Actor, Movie
-from auth import requires_auth, AuthError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from models import (
+    DB_REPLICA_PIN_SECONDS, db, database_path, replica_paths, setup_db, commit_listeners, pool_stats, Actor, Change, Movie,
+    Stat
+)
+from auth import jwks, requires_auth, requires_metrics_token, AuthError
+from cache import create_backend, read_cache
+from limits import Overloaded
+from singleflight import SingleFlight
+from compression import (
+    COMPRESS_MIN_SIZE, add_vary, choose_encoding, compress_body, compress_chunks, compressible, encoded_etag
+)
+from search import search
+from metrics import UNMATCHED, finish_request, phase, registry, start_request
+from profiling import SERVER_TIMING, server_timing
+from resources import (
+    COUNT_PER_PAGE, EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportEncoder, batch_results, changes_args, changes_payload,
+    dumps, export_query, is_fresh, json_default, list_payload, list_query, list_validators, match_versions, paginate,
+    parse_value, related, row_etag, search_args, stats_payload, validate_batch, validate_cast, validate_ids,
+    validate_patch, version_etag
+)
 from errors import errors
 
 
-app = Flask(__name__)
-db = setup_db(app)
-db.create_all()
-CORS(app)
+class JSONEncoder(BaseJSONEncoder):
+    """Encode dates as ISO 8601 strings instead of HTTP dates."""
 
-COUNT_PER_PAGE = 5
+    def default(self, o):
+        if isinstance(o, date): return json_default(o)
+        return super().default(o)
 
-@app.after_request
+    def encode(self, o):
+        with phase('serialize'):
+            return super().encode(o)
+
+
+# fetch the signing keys and open the pool's connections when a worker starts
+WARMUP = os.environ.get('WARMUP', 'false').lower() in ('1', 'true', 'yes')
+
+api = Blueprint('api', __name__)
+commit_listeners.append(read_cache.invalidate)
+# concurrent identical cache misses of the threads of this worker
+reads = SingleFlight('reads')
+# clients that wrote and tables written in the last DB_REPLICA_PIN_SECONDS, shared by workers with READ_CACHE_URL
+replica_pins = create_backend(maxsize=10000, ttl=DB_REPLICA_PIN_SECONDS, prefix='casting:pin:')
+
+
+def pin_tables(changes):
+    # replica reads of these tables are not cached until the pin expires, see cached
+    for table in {table for table, _, _ in changes}:
+        replica_pins.set(f'table:{table}', True)
+
+
+commit_listeners.append(pin_tables)
+
+
+def create_app(config=None):
+    """Build the app without connecting to the database.
+
+    The engine connects on first use. Tables are created by
+    ``python manage.py db upgrade`` (or ``create_db``), not on import.
+    """
+    config = dict(config or {})
+    app = Flask(__name__)
+    app.json_encoder = JSONEncoder
+    setup_db(app, config.pop('SQLALCHEMY_DATABASE_URI', database_path),
+             config.pop('DATABASE_REPLICA_URLS', replica_paths))
+    app.config.update(config)
+    CORS(app)
+    app.register_blueprint(api)
+    return app
+
+
+def init_worker(app, warmup=WARMUP):
+    """Prepare a server worker after the fork.
+
+    Connections inherited from a preloading master are dropped so workers
+    never share a socket. With ``warmup`` the signing keys are fetched and
+    the pool is filled before the first request instead of during it.
+    """
+    with app.app_context():
+        for key in app.extensions['replicas'].keys:
+            db.get_engine(bind=key).dispose()
+        engine = db.engine
+        engine.dispose()
+        if not warmup: return
+        jwks.refresh()
+        size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+        connections = [engine.connect() for _ in range(size)]
+        for connection in connections:
+            connection.close()
+
+
+@api.after_app_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PATCH, DELETE, OPTIONS')
     return response
 
 
-@app.route('/')
+@api.before_app_request
+def start_metrics():
+    g.metrics_token = start_request()
+
+
+@api.after_app_request
+def finish_metrics(response):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        route = request.url_rule.rule if request.url_rule else UNMATCHED
+        finish_request(token, route, request.method, response.status_code)
+    return response
+
+
+# registered before compress_response, so it runs after it and sees the compress phase
+@api.after_app_request
+def add_server_timing(response):
+    timing = server_timing() if SERVER_TIMING else None
+    if timing is not None: response.headers['Server-Timing'] = timing
+    return response
+
+
+def pin_key():
+    auth = request.headers.get('Authorization', None)
+    return hashlib.sha1(auth.encode()).hexdigest() if auth else None
+
+
+@api.before_app_request
+def route_reads():
+    """Read from a replica in GET requests, unless the client wrote recently."""
+    if request.method in ('GET', 'HEAD') and current_app.extensions['replicas']:
+        key = pin_key()
+        g.pinned = key is not None and replica_pins.get(key) is not None
+        db.session.info['read_only'] = not g.pinned
+
+
+@api.after_app_request
+def pin_writes(response):
+    if current_app.extensions['replicas'] and db.session.registry.has() and db.session.info.get('pinned'):
+        key = pin_key()
+        if key is not None: replica_pins.set(key, True)
+    return response
+
+
+@api.after_app_request
+def compress_response(response):
+    """gzip or brotli for clients that accept it, streamed responses chunk by chunk.
+
+    A compressed body gets the encoding in its ETag; a 304 keeps the tag
+    the client sent, in case it holds the compressed body.
+    """
+    etag, weak = response.get_etag()
+    if response.status_code == 304 and etag:
+        add_vary(response.headers)
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding and request.if_none_match.contains_weak(encoded_etag(etag, encoding)):
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        return response
+    if not compressible(response.status_code, response.headers): return response
+    add_vary(response.headers)
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None: return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE: return response
+        response.set_data(compress_body(body, encoding, etag is not None))
+        if etag: response.set_etag(encoded_etag(etag, encoding), weak)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def fresh(etag, last_modified):
+    return is_fresh(request.if_none_match, request.if_modified_since, etag, last_modified)
+
+
+def json_response(body, status=200):
+    return Response(body, status, mimetype='application/json')
+
+
+def conditional(etag, last_modified, body):
+    response = Response(status=304) if fresh(etag, last_modified) else json_response(body)
+    response.set_etag(etag)
+    if last_modified: response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cached(table, key, load):
+    """Serve a GET from the read cache, calling ``load`` on a miss.
+
+    ``load`` returns the ETag, Last-Modified and a callable building the
+    payload, so a conditional request is answered before the body is built.
+    The cache keeps the encoded body, so a hit skips serialization too.
+    A client pinned to the primary skips the entries read from replicas,
+    and a load from a replica is not stored while the table was written in
+    the last ``DB_REPLICA_PIN_SECONDS``, as the replica may lag behind.
+    Concurrent misses of a key run ``load`` once and share the entry; the
+    key includes the table's generation, so no one gets a load that began
+    before a write they saw commit.
+    """
+    entry = None if g.get('pinned') else read_cache.get(key)
+    if entry is None:
+        generation = read_cache.generation(table)
+
+        def load_entry():
+            etag, last_modified, build = load()
+            if fresh(etag, last_modified): return etag, last_modified, None
+            entry = (etag, last_modified, dumps(build()))
+            if db.session.info.get('replica') is None or replica_pins.get(f'table:{table}') is None:
+                read_cache.set(table, key, entry, generation)
+            return entry
+
+        # conditional requests may be answered before the body is built
+        coalesce = not (g.get('pinned') or request.if_none_match or request.if_modified_since)
+        entry = reads.do(f'{key}:{generation}', load_entry) if coalesce else load_entry()
+    return conditional(*entry)
+
+
+def get_resource(model, id, render):
+    table = model.__tablename__
+
+    def load():
+        row = model.query.get(id)
+        if row is None: abort(404)
+        return row_etag(model, row), row.updated_at, lambda: render(row)
+
+    return cached(table, read_cache.entity_key(table, id), load)
+
+
+def list_resource(model, name):
+    table = model.__tablename__
+    query_string = request.query_string.decode()
+    conditions, order, fields = list_query(model, request.args)
+
+    def load():
+        etag, total = list_validators(db.session, model, conditions, query_string)
+        return etag, None, lambda: build(total)
+
+    def build(total):
+        rows, next_cursor = paginate(db.session, model, request.args, conditions, order, fields)
+        return list_payload(name, request.args, rows, next_cursor, total)
+
+    if 'include' in request.args:
+        # the list's validators do not cover the embedded rows of other tables
+        _, total = list_validators(db.session, model, conditions, query_string)
+        return json_response(dumps(build(total)))
+    return cached(table, read_cache.list_key(table, query_string), load)
+
+
+def search_resource(model, name):
+    q, limit = search_args(request.args)
+    return jsonify({
+        'success': True,
+        name: search(model, q, limit)
+    })
+
+
+def patch_resource(model, id):
+    """One UPDATE, limited to the versions in If-Match; the new ETag is returned."""
+    values = validate_patch(model, request.get_json())
+    try:
+        version = model.update_one(id, values, match_versions(model, id, request.if_match))
+    except IntegrityError: abort(400)
+    if version is None: abort(404)
+    if version is False: abort(412)
+    response = jsonify({
+        'success': True
+    })
+    response.set_etag(version_etag(model, id, version))
+    return response
+
+
+def delete_resource(model, id):
+    found = model.delete_one(id, match_versions(model, id, request.if_match))
+    if found is None: abort(404)
+    if found is False: abort(412)
+    return jsonify({
+        'success': True
+    })
+
+
+def post_batch(model):
+    items = validate_batch(model, request.get_json())
+    try:
+        ids = model.bulk_add(items)
+    except IntegrityError: abort(400)
+    return jsonify({
+        'success': True,
+        'ids': ids
+    })
+
+
+def patch_batch(model):
+    items = validate_batch(model, request.get_json(), partial=True)
+    found = model.bulk_update(items)
+    return jsonify({
+        'success': True,
+        'results': batch_results([item['id'] for item in items], found)
+    })
+
+
+def delete_batch(model):
+    ids = validate_ids(request.get_json())
+    found = model.bulk_delete(ids)
+    return jsonify({
+        'success': True,
+        'results': batch_results(ids, found)
+    })
+
+
+def export(model):
+    """Stream every row of the model's table as NDJSON or CSV.
+
+    Rows come from a server-side cursor as plain tuples and are written out
+    chunk by chunk, so worker memory does not grow with the table.
+    """
+    export_format, names, stmt = export_query(model, request.args)
+    engine = db.session.get_bind()
+
+    def generate():
+        encoder = ExportEncoder(export_format, names)
+        yield encoder.header()
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(stmt)
+            for rows in result.partitions(EXPORT_CHUNK_SIZE):
+                yield encoder.encode(rows)
+
+    return Response(generate(), mimetype=EXPORT_FORMATS[export_format], headers={
+        'Content-Disposition': f'attachment; filename={model.__tablename__}.{export_format}'
+    })
+
+
+def changes_resource(model):
+    """The changes of a model after ``?since=<cursor>``; without it only the current cursor."""
+    since, per_page = changes_args(request.args)
+    feed = ([], Change.head(), False) if since is None else Change.feed(model, since, per_page)
+    return json_response(dumps(changes_payload(feed)))
+
+
+@api.route('/')
 def index():
     return 'server is working'
 
 
-@app.route('/actors', methods=['GET'])
-@requires_auth('get:actors')
-def get_actors():
-    page = request.args.get('page', 1, type=int)
-    actors = [actor.format() for actor in Actor.query.all()]
-    start = COUNT_PER_PAGE * (page - 1)
-    end = start + COUNT_PER_PAGE
-    selection = actors[start:end]
-    if len(selection) == 0: abort(404)
+@api.route('/metrics', methods=['GET'])
+@requires_metrics_token
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route('/internal/pool', methods=['GET'])
+@requires_metrics_token
+def pool_status():
+    replicas = current_app.extensions['replicas']
     return jsonify({
         'success': True,
-        'actors': selection,
-        'all_actors': len(actors)
+        'pool': pool_stats(db.engine.pool),
+        'replicas': {key: dict(stats, pool=pool_stats(db.get_engine(bind=key).pool))
+                     for key, stats in replicas.stats().items()}
     })
 
 
-@app.route('/actors/<int:id>', methods=['GET'])
+@api.route('/stats/actors', methods=['GET'])
+@requires_auth('get:actors')
+def get_actor_stats():
+    return jsonify(stats_payload(Stat.summary(Actor)))
+
+
+@api.route('/stats/movies', methods=['GET'])
+@requires_auth('get:movies')
+def get_movie_stats():
+    return jsonify(stats_payload(Stat.summary(Movie)))
+
+
+@api.route('/actors', methods=['GET'])
+@requires_auth('get:actors')
+def get_actors():
+    return list_resource(Actor, 'actors')
+
+
+@api.route('/actors/search', methods=['GET'])
+@requires_auth('get:actors')
+def search_actors():
+    return search_resource(Actor, 'actors')
+
+
+@api.route('/actors/export', methods=['GET'])
+@requires_auth('get:actors')
+def export_actors():
+    return export(Actor)
+
+
+@api.route('/actors/changes', methods=['GET'])
+@requires_auth('get:actors')
+def get_actor_changes():
+    return changes_resource(Actor)
+
+
+@api.route('/actors/<int:id>', methods=['GET'])
 @requires_auth('get:actors')
 def get_actor(id):
-    actor = Actor.query.get(id)
-    if actor is None: abort(404)
-    return jsonify({
+    return get_resource(Actor, id, lambda actor: {
         'success': True,
         'id': actor.id,
         'name': actor.name,
@@ -54,7 +418,13 @@ def get_actor(id):
     })
 
 
-@app.route('/actors', methods=['POST'])
+@api.route('/actors/<int:id>/movies', methods=['GET'])
+@requires_auth('get:actors')
+def get_actor_movies(id):
+    return jsonify(related(db.session, Actor, id, 'movies'))
+
+
+@api.route('/actors', methods=['POST'])
 @requires_auth('post:actors')
 def post_actors():
     req = request.get_json()
@@ -72,56 +442,64 @@ def post_actors():
     })
 
 
-@app.route('/actors/<int:id>', methods=['PATCH'])
+@api.route('/actors/<int:id>', methods=['PATCH'])
 @requires_auth('patch:actors')
 def patch_actors(id):
-    req = request.get_json()
-    if req is None: abort(400)
-    actor = Actor.query.get(id)
-    if actor is None: abort(404)
-    actor.name = req.get('name', actor.name)
-    actor.age = req.get('age', actor.age)
-    actor.gender = req.get('gender', actor.gender)
-    actor.update()
-    return jsonify({
-        'success': True
-    })
+    return patch_resource(Actor, id)
 
 
-@app.route('/actors/<int:id>', methods=['DELETE'])
+@api.route('/actors/<int:id>', methods=['DELETE'])
 @requires_auth('delete:actors')
 def delete_actors(id):
-    actor = Actor.query.get(id)
-    if actor is None: abort(404)
-    actor.delete()
-    return jsonify({
-        'success': True
-    })
+    return delete_resource(Actor, id)
+
+
+@api.route('/actors/batch', methods=['POST'])
+@requires_auth('post:actors')
+def post_actors_batch():
+    return post_batch(Actor)
+
+
+@api.route('/actors/batch', methods=['PATCH'])
+@requires_auth('patch:actors')
+def patch_actors_batch():
+    return patch_batch(Actor)
+
 
+@api.route('/actors/batch', methods=['DELETE'])
+@requires_auth('delete:actors')
+def delete_actors_batch():
+    return delete_batch(Actor)
 
 
-@app.route('/movies', methods=['GET'])
+@api.route('/movies', methods=['GET'])
 @requires_auth('get:movies')
 def get_movies():
-    page = request.args.get('page', 1, type=int)
-    movies = [movie.format() for movie in Movie.query.all()]
-    start = COUNT_PER_PAGE * (page - 1)
-    end = start + COUNT_PER_PAGE
-    selection = movies[start:end]
-    if len(selection) == 0: abort(404)
-    return jsonify({
-        'success': True,
-        'movies': movies,
-        'all_movies': len(movies)
-    })
+    return list_resource(Movie, 'movies')
+
+
+@api.route('/movies/search', methods=['GET'])
+@requires_auth('get:movies')
+def search_movies():
+    return search_resource(Movie, 'movies')
+
+
+@api.route('/movies/export', methods=['GET'])
+@requires_auth('get:movies')
+def export_movies():
+    return export(Movie)
 
 
-@app.route('/movies/<int:id>', methods=['GET'])
+@api.route('/movies/changes', methods=['GET'])
+@requires_auth('get:movies')
+def get_movie_changes():
+    return changes_resource(Movie)
+
+
+@api.route('/movies/<int:id>', methods=['GET'])
 @requires_auth('get:movies')
 def get_movie(id):
-    movie = Movie.query.get(id)
-    if movie is None: abort(404)
-    return jsonify({
+    return get_resource(Movie, id, lambda movie: {
         'success': True,
         'id': movie.id,
         'title': movie.title,
@@ -129,7 +507,26 @@ def get_movie(id):
     })
 
 
-@app.route('/movies', methods=['POST'])
+@api.route('/movies/<int:id>/cast', methods=['GET'])
+@requires_auth('get:movies')
+def get_movie_cast(id):
+    return jsonify(related(db.session, Movie, id, 'cast'))
+
+
+@api.route('/movies/<int:id>/cast', methods=['PUT'])
+@requires_auth('patch:movies')
+def put_movie_cast(id):
+    cast = validate_cast(request.get_json())
+    try:
+        found = Movie.replace_cast(id, cast)
+    except IntegrityError: abort(400)
+    if not found: abort(404)
+    return jsonify({
+        'success': True
+    })
+
+
+@api.route('/movies', methods=['POST'])
 @requires_auth('post:movies')
 def post_movies():
     req = request.get_json()
@@ -137,7 +534,7 @@ def post_movies():
     title = req.get('title', None)
     rdate = req.get('release_date', None)
     if title is None or rdate is None: abort(400)
-    movie = Movie(title, rdate)
+    movie = Movie(title, parse_value(Movie, 'release_date', rdate))
     movie.add()
     return jsonify({
         'success': True,
@@ -145,35 +542,37 @@ def post_movies():
     })
 
 
-@app.route('/movies/<int:id>', methods=['PATCH'])
+@api.route('/movies/<int:id>', methods=['PATCH'])
 @requires_auth('patch:movies')
 def patch_movies(id):
-    movie = Movie.query.get(id)
-    if movie is None: abort(404)
-    req = request.get_json()
-    if req is None: abort(400)
-    title = req.get('title', movie.title)
-    rdate = req.get('release_date', movie.release_date)
-    movie.title = title
-    movie.release_date = rdate
-    movie.update()
-    return jsonify({
-        'success': True
-    })
+    return patch_resource(Movie, id)
 
 
-@app.route('/movies/<int:id>', methods=['DELETE'])
+@api.route('/movies/<int:id>', methods=['DELETE'])
 @requires_auth('delete:movies')
 def delete_movies(id):
-    movie = Movie.query.get(id)
-    if movie is None: abort(404)
-    movie.delete()
-    return jsonify({
-        'success': True
-    })
+    return delete_resource(Movie, id)
+
+
+@api.route('/movies/batch', methods=['POST'])
+@requires_auth('post:movies')
+def post_movies_batch():
+    return post_batch(Movie)
 
 
-@app.errorhandler(400)
+@api.route('/movies/batch', methods=['PATCH'])
+@requires_auth('patch:movies')
+def patch_movies_batch():
+    return patch_batch(Movie)
+
+
+@api.route('/movies/batch', methods=['DELETE'])
+@requires_auth('delete:movies')
+def delete_movies_batch():
+    return delete_batch(Movie)
+
+
+@api.app_errorhandler(400)
 def bad_request(e):
     return jsonify({
         'success': False,
@@ -181,7 +580,7 @@ def bad_request(e):
         'message': 'bad request'
     }), 400
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(e):
     return jsonify({
         'success': False,
@@ -189,7 +588,7 @@ def unauthorized(e):
         'message': 'unauthorized'
     }), 401
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(e):
     return jsonify({
         'success': False,
@@ -197,7 +596,7 @@ def not_found(e):
         'message': 'not found'
     }), 404
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def method_not_allowed(e):
     return jsonify({
         'success': False,
@@ -205,7 +604,43 @@ def method_not_allowed(e):
         'message': 'method not allowed'
     })
 
-@app.errorhandler(AuthError)
+@api.app_errorhandler(410)
+def gone(e):
+    return jsonify({
+        'success': False,
+        'error': 410,
+        'message': 'gone'
+    }), 410
+
+@api.app_errorhandler(412)
+def precondition_failed(e):
+    return jsonify({
+        'success': False,
+        'error': 412,
+        'message': 'precondition failed'
+    }), 412
+
+@api.app_errorhandler(413)
+def payload_too_large(e):
+    return jsonify({
+        'success': False,
+        'error': 413,
+        'message': 'payload too large'
+    }), 413
+
+@api.app_errorhandler(Overloaded)
+def overloaded(ex):
+    response = jsonify({
+        'success': False,
+        'error': ex.status_code,
+        'message': errors[ex.status_code],
+        'description': ex.description
+    })
+    response.status_code = ex.status_code
+    response.headers['Retry-After'] = str(ex.retry_after)
+    return response
+
+@api.app_errorhandler(AuthError)
 def auth_error(ex):
     return jsonify({
         'success': False,
@@ -215,5 +650,8 @@ def auth_error(ex):
     }), ex.status_code
 
 
+app = create_app()
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,556 @@
+"""ASGI entry point serving the routes of ``app.py`` on asyncio.
+
+Run it with ``uvicorn asgi:app``. Requests share the resource helpers, the
+token and read caches, the permissions and the error JSON of the Flask app.
+Database work goes through SQLAlchemy's asyncio engine: the ORM helpers run
+inside ``AsyncSession.run_sync`` and exports stream from an async cursor, so
+a worker keeps serving other requests while one waits on the database. A
+token that is not cached yet is verified in the default thread pool, so a
+JWKS fetch does not block the event loop either.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+from functools import partial
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, BadRequest, MethodNotAllowed, NotFound, abort
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag, unquote_etag
+from werkzeug.urls import url_decode
+from werkzeug.utils import get_content_type
+from flask_cors.core import DEFAULT_OPTIONS, get_cors_headers, serialize_options
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from models import (
+    database_path, commit_listeners, engine_options, pool_stats, TimedAsyncQueuePool, Actor, Change, Movie, Stat
+)
+from auth import AuthError, check_metrics_token, check_permissions, parse_auth_header, token_cache, verify_token
+from cache import read_cache
+from limits import Overloaded, admission, limiter
+from singleflight import AsyncSingleFlight
+from compression import (
+    COMPRESS_MIN_SIZE, add_vary, choose_encoding, compress_async_chunks, compress_body, compressible, encoded_etag
+)
+from search import search
+from metrics import UNMATCHED, finish_request, phase, registry, start_request
+from profiling import SERVER_TIMING, server_timing
+from resources import (
+    CHANGES_POLL_INTERVAL, CHANGES_STREAM_SECONDS, EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportEncoder, batch_results,
+    change_event, changes_args, changes_payload, dumps, export_query, is_fresh, list_payload, list_query,
+    list_validators, match_versions, paginate, parse_value, related, row_etag, search_args, stats_payload,
+    validate_batch, validate_cast, validate_ids, validate_patch, version_etag
+)
+from errors import errors
+
+# asyncio drivers of the database backends
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+CORS_OPTIONS = serialize_options(DEFAULT_OPTIONS)
+
+
+def async_database_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+database_url = os.environ.get('ASYNC_DATABASE_URL') or async_database_url(database_path)
+# created by connect() at startup, so importing the module needs no async driver
+engine = None
+Session = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+
+def connect():
+    """Create the async engine on first use."""
+    global engine
+    if engine is None:
+        engine = create_async_engine(database_url, **engine_options(str(database_url), TimedAsyncQueuePool))
+        Session.configure(bind=engine)
+    return engine
+
+
+commit_listeners.append(read_cache.invalidate)
+reads = AsyncSingleFlight('reads')
+# set and cleared on each commit of this worker, which wakes the change streams waiting on it
+changes_posted = asyncio.Event()
+
+
+def notify_streams(changes):
+    changes_posted.set()
+    changes_posted.clear()
+
+
+commit_listeners.append(notify_streams)
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope['query_string'].decode('latin-1')
+        self.args = url_decode(scope['query_string'])
+        self.headers = Headers([(key.decode('latin-1'), value.decode('latin-1'))
+                                for key, value in scope['headers']])
+        self.body = body
+        self.rule = UNMATCHED
+
+    def get_json(self):
+        """Parse the body like Flask: None unless it is JSON, 400 if malformed."""
+        mimetype = self.headers.get('Content-Type', '').split(';')[0].strip()
+        if not (mimetype == 'application/json' or mimetype.startswith('application/')
+                and mimetype.endswith('+json')):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError: raise BadRequest()
+
+    def fresh(self, etag, last_modified):
+        return is_fresh(parse_etags(self.headers.get('If-None-Match')),
+                        parse_date(self.headers.get('If-Modified-Since')), etag, last_modified)
+
+
+class Response:
+    """A response whose body is bytes or an async iterator of str or bytes chunks."""
+
+    def __init__(self, body=b'', status=200, mimetype='application/json', headers=None):
+        self.body = body
+        self.status = status
+        self.headers = Headers(headers)
+        if mimetype: self.headers['Content-Type'] = get_content_type(mimetype, 'utf-8')
+
+    async def send(self, send, head=False):
+        streaming = not isinstance(self.body, bytes)
+        if not streaming: self.headers['Content-Length'] = str(len(self.body))
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                        for key, value in self.headers.items()]
+        })
+        if streaming and not head:
+            async for chunk in self.body:
+                if isinstance(chunk, str): chunk = chunk.encode()
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'' if head or streaming else self.body})
+
+
+def jsonify(payload, status=200):
+    """Serialize like Flask's ``jsonify`` with the app's date encoding."""
+    return Response(dumps(payload), status)
+
+
+def error_response(code, description=None):
+    payload = {
+        'success': False,
+        'error': code,
+        'message': errors[code]
+    }
+    if description is not None: payload['description'] = description
+    return jsonify(payload, code)
+
+
+def conditional(request, etag, last_modified, body):
+    if request.fresh(etag, last_modified):
+        response = Response(status=304, mimetype=None)
+    else:
+        response = Response(body)
+    response.headers['ETag'] = quote_etag(etag)
+    if last_modified: response.headers['Last-Modified'] = http_date(last_modified)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+async def cached(request, table, key, load):
+    """Serve a GET from the read cache, running ``load`` in a session on a miss.
+
+    ``load`` takes a sync session and returns the ETag, Last-Modified and a
+    callable building the payload from the same session. Concurrent misses
+    of a key share one load, like in the Flask app.
+    """
+    entry = read_cache.get(key)
+    if entry is None:
+        generation = read_cache.generation(table)
+
+        async def load_entry():
+            async with Session() as session:
+                etag, last_modified, build = await session.run_sync(load)
+                if request.fresh(etag, last_modified): return etag, last_modified, None
+                entry = (etag, last_modified, dumps(await session.run_sync(build)))
+            read_cache.set(table, key, entry, generation)
+            return entry
+
+        coalesce = 'If-None-Match' not in request.headers and 'If-Modified-Since' not in request.headers
+        entry = await (reads.do(f'{key}:{generation}', load_entry) if coalesce else load_entry())
+    return conditional(request, *entry)
+
+
+def render(model, row):
+    payload = {'success': True, 'id': row.id}
+    payload.update((name, getattr(row, name)) for name in model.fields)
+    return payload
+
+
+async def get_resource(request, model, name, id):
+    table = model.__tablename__
+
+    def load(session):
+        row = session.get(model, id)
+        if row is None: abort(404)
+        return row_etag(model, row), row.updated_at, lambda session: render(model, row)
+
+    return await cached(request, table, read_cache.entity_key(table, id), load)
+
+
+async def list_resource(request, model, name):
+    table = model.__tablename__
+    conditions, order, fields = list_query(model, request.args)
+
+    def load(session):
+        etag, total = list_validators(session, model, conditions, request.query_string)
+        return etag, None, lambda session: build(session, total)
+
+    def build(session, total):
+        rows, next_cursor = paginate(session, model, request.args, conditions, order, fields)
+        return list_payload(name, request.args, rows, next_cursor, total)
+
+    if 'include' in request.args:
+        # the list's validators do not cover the embedded rows of other tables
+        async with Session() as session:
+            _, total = await session.run_sync(
+                lambda session: list_validators(session, model, conditions, request.query_string))
+            return jsonify(await session.run_sync(lambda session: build(session, total)))
+    return await cached(request, table, read_cache.list_key(table, request.query_string), load)
+
+
+async def stats_resource(request, model, name):
+    async with Session() as session:
+        return jsonify(stats_payload(await session.run_sync(lambda session: Stat.summary(model, session))))
+
+
+async def related_resource(request, model, name, id, include):
+    async with Session() as session:
+        return jsonify(await session.run_sync(lambda session: related(session, model, id, include)))
+
+
+async def put_cast(request, model, name, id):
+    cast = validate_cast(request.get_json())
+    async with Session() as session:
+        try:
+            found = await session.run_sync(lambda session: model.replace_cast(id, cast, session))
+        except IntegrityError: abort(400)
+    if not found: abort(404)
+    return jsonify({
+        'success': True
+    })
+
+
+async def search_resource(request, model, name):
+    q, limit = search_args(request.args)
+    async with Session() as session:
+        rows = await session.run_sync(lambda session: search(model, q, limit, session))
+    return jsonify({
+        'success': True,
+        name: rows
+    })
+
+
+async def export(request, model, name):
+    export_format, names, stmt = export_query(model, request.args)
+
+    async def generate():
+        encoder = ExportEncoder(export_format, names)
+        yield encoder.header()
+        async with engine.connect() as connection:
+            result = await connection.stream(stmt)
+            async for rows in result.partitions(EXPORT_CHUNK_SIZE):
+                yield encoder.encode(rows)
+
+    return Response(generate(), mimetype=EXPORT_FORMATS[export_format], headers={
+        'Content-Disposition': f'attachment; filename={model.__tablename__}.{export_format}'
+    })
+
+
+async def changes_resource(request, model, name):
+    since, per_page = changes_args(request.args)
+    async with Session() as session:
+        if since is None:
+            feed = [], await session.run_sync(Change.head), False
+        else:
+            feed = await session.run_sync(lambda session: Change.feed(model, since, per_page, session))
+    return jsonify(changes_payload(feed))
+
+
+async def stream_changes(request, model, name):
+    """Push the changes of a model as Server-Sent Events.
+
+    Only this app serves the streams: a stream waits for changes for up to
+    ``CHANGES_STREAM_SECONDS``, which would hold a thread of a sync worker.
+    """
+    since, per_page = changes_args(request.args, request.headers.get('Last-Event-ID'))
+
+    async def poll(since):
+        async with Session() as session:
+            if since is None: since = await session.run_sync(Change.head)
+            return await session.run_sync(lambda session: Change.feed(model, since, per_page, session))
+
+    feed = await poll(since)
+    if feed is None: abort(410)
+
+    async def generate(feed):
+        deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+        yield f'retry: {int(CHANGES_POLL_INTERVAL * 1000)}\n\n'
+        while feed is not None:
+            changes, cursor, more = feed
+            for change in changes:
+                yield change_event(change)
+            if not more:
+                if time.monotonic() >= deadline: return
+                yield ': keep-alive\n\n'
+                try:
+                    await asyncio.wait_for(changes_posted.wait(), CHANGES_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            feed = await poll(cursor)
+        yield 'event: gone\ndata: {}\n\n'
+
+    return Response(generate(feed), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def post_resource(request, model, name):
+    req = request.get_json()
+    if req is None: abort(400)
+    values = [req.get(field, None) for field in model.fields]
+    if None in values: abort(400)
+    row = model(*[parse_value(model, field, value) for field, value in zip(model.fields, values)])
+    async with Session() as session:
+        session.add(row)
+        await session.commit()
+    return jsonify({
+        'success': True,
+        'id': row.id
+    })
+
+
+async def patch_resource(request, model, name, id):
+    values = validate_patch(model, request.get_json())
+    versions = match_versions(model, id, parse_etags(request.headers.get('If-Match')))
+    async with Session() as session:
+        try:
+            version = await session.run_sync(lambda session: model.update_one(id, values, versions, session))
+        except IntegrityError: abort(400)
+    if version is None: abort(404)
+    if version is False: abort(412)
+    response = jsonify({
+        'success': True
+    })
+    response.headers['ETag'] = quote_etag(version_etag(model, id, version))
+    return response
+
+
+async def delete_resource(request, model, name, id):
+    versions = match_versions(model, id, parse_etags(request.headers.get('If-Match')))
+    async with Session() as session:
+        found = await session.run_sync(lambda session: model.delete_one(id, versions, session))
+    if found is None: abort(404)
+    if found is False: abort(412)
+    return jsonify({
+        'success': True
+    })
+
+
+async def post_batch(request, model, name):
+    items = validate_batch(model, request.get_json())
+    async with Session() as session:
+        try:
+            ids = await session.run_sync(lambda session: model.bulk_add(items, session))
+        except IntegrityError: abort(400)
+    return jsonify({
+        'success': True,
+        'ids': ids
+    })
+
+
+async def patch_batch(request, model, name):
+    items = validate_batch(model, request.get_json(), partial=True)
+    async with Session() as session:
+        found = await session.run_sync(lambda session: model.bulk_update(items, session))
+    return jsonify({
+        'success': True,
+        'results': batch_results([item['id'] for item in items], found)
+    })
+
+
+async def delete_batch(request, model, name):
+    ids = validate_ids(request.get_json())
+    async with Session() as session:
+        found = await session.run_sync(lambda session: model.bulk_delete(ids, session))
+    return jsonify({
+        'success': True,
+        'results': batch_results(ids, found)
+    })
+
+
+# (method, rule under /<name>, permission action, handler) in the order of app.py
+ROUTES = [
+    ('GET', '', 'get', list_resource),
+    ('GET', '/search', 'get', search_resource),
+    ('GET', '/export', 'get', export),
+    ('GET', '/changes', 'get', changes_resource),
+    ('GET', '/changes/stream', 'get', stream_changes),
+    ('GET', '/<int:id>', 'get', get_resource),
+    ('POST', '', 'post', post_resource),
+    ('PATCH', '/<int:id>', 'patch', patch_resource),
+    ('DELETE', '/<int:id>', 'delete', delete_resource),
+    ('POST', '/batch', 'post', post_batch),
+    ('PATCH', '/batch', 'patch', patch_batch),
+    ('DELETE', '/batch', 'delete', delete_batch)
+]
+
+
+def compile_rule(rule):
+    """Regex of a Flask-style rule such as ``/actors/<int:id>``."""
+    return re.compile(re.sub(r'<int:(\w+)>', r'(?P<\1>\\d+)', rule))
+
+
+url_map = []
+for model, name in ((Actor, 'actors'), (Movie, 'movies')):
+    for method, rule, action, handler in ROUTES:
+        rule = f'/{name}{rule}'
+        url_map.append((method, rule, compile_rule(rule), f'{action}:{name}', handler, model, name))
+    url_map.append(('GET', f'/stats/{name}', compile_rule(f'/stats/{name}'), f'get:{name}', stats_resource,
+                    model, name))
+    for include in model.includes:
+        rule = f'/{name}/<int:id>/{include}'
+        url_map.append(('GET', rule, compile_rule(rule), f'get:{name}', partial(related_resource, include=include),
+                        model, name))
+url_map.append(('PUT', '/movies/<int:id>/cast', compile_rule('/movies/<int:id>/cast'), 'patch:movies', put_cast,
+                Movie, 'movies'))
+
+
+def match(request, method):
+    """Return the handler, permission and arguments of a request, 404/405 if none."""
+    allowed = set()
+    for route_method, rule, pattern, permission, handler, model, name in url_map:
+        matched = pattern.fullmatch(request.path)
+        if matched is None: continue
+        if route_method != method:
+            allowed.add(route_method)
+            continue
+        request.rule = rule
+        kwargs = {key: int(value) for key, value in matched.groupdict().items()}
+        return handler, permission, dict(kwargs, model=model, name=name)
+    if allowed: raise MethodNotAllowed(sorted(allowed))
+    raise NotFound()
+
+
+async def authenticate(request, permission):
+    with phase('auth'):
+        token = parse_auth_header(request.headers.get('Authorization', None))
+        payload = token_cache.get(token)
+        if payload is None:
+            payload = await asyncio.get_running_loop().run_in_executor(None, verify_token, token)
+        check_permissions(permission, payload)
+        limiter.check(permission, payload)
+
+
+async def dispatch(request):
+    if request.path == '/':
+        request.rule = '/'
+        return Response(b'server is working', mimetype='text/html')
+    method = 'GET' if request.method == 'HEAD' else request.method
+    try:
+        if request.path == '/metrics' and method == 'GET':
+            request.rule = '/metrics'
+            check_metrics_token(request.headers.get('Authorization'))
+            return Response(registry.render().encode(), mimetype='text/plain; version=0.0.4')
+        if request.path == '/internal/pool' and method == 'GET':
+            request.rule = '/internal/pool'
+            check_metrics_token(request.headers.get('Authorization'))
+            return jsonify({
+                'success': True,
+                'pool': pool_stats(engine.sync_engine.pool)
+            })
+        if method == 'OPTIONS':
+            if not any(route[2].fullmatch(request.path) for route in url_map): raise NotFound()
+            return Response(mimetype='text/html')
+        handler, permission, kwargs = match(request, method)
+        with admission.admit():
+            await authenticate(request, permission)
+            return await handler(request, **kwargs)
+    except AuthError as ex:
+        return error_response(ex.status_code, ex.description)
+    except Overloaded as ex:
+        response = error_response(ex.status_code, ex.description)
+        response.headers['Retry-After'] = str(ex.retry_after)
+        return response
+    except HTTPException as ex:
+        if ex.code in errors: return error_response(ex.code)
+        return Response(ex.get_body().encode(), ex.code, mimetype='text/html')
+
+
+def compress_response(request, response):
+    """Like the Flask app's, with the encoding in the ETag of a compressed body."""
+    etag, weak = unquote_etag(response.headers.get('ETag'))
+    if response.status == 304 and etag:
+        add_vary(response.headers)
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding and parse_etags(request.headers.get('If-None-Match')).contains_weak(encoded_etag(etag, encoding)):
+            response.headers['ETag'] = quote_etag(encoded_etag(etag, encoding), weak)
+        return
+    if not compressible(response.status, response.headers): return
+    add_vary(response.headers)
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None: return
+    if isinstance(response.body, bytes):
+        if len(response.body) < COMPRESS_MIN_SIZE: return
+        response.body = compress_body(response.body, encoding, etag is not None)
+        if etag: response.headers['ETag'] = quote_etag(encoded_etag(etag, encoding), weak)
+    else:
+        response.body = compress_async_chunks(response.body, encoding)
+    response.headers['Content-Encoding'] = encoding
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'): return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                connect()
+            except Exception as ex:
+                await send({'type': 'lifespan.startup.failed', 'message': str(ex)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if engine is not None: await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan': return await lifespan(receive, send)
+    # servers without lifespan support never sent the startup event
+    connect()
+    token = start_request()
+    request = Request(scope, await read_body(receive))
+    response = await dispatch(request)
+    compress_response(request, response)
+    if SERVER_TIMING: response.headers['Server-Timing'] = server_timing()
+    response.headers.extend(get_cors_headers(CORS_OPTIONS, request.headers, request.method))
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PATCH, DELETE, OPTIONS')
+    await response.send(send, head=request.method == 'HEAD')
+    finish_request(token, request.rule, request.method, response.status)
@@ -1,14 +1,37 @@
 import os
+import re
 import json
+import time
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
 from functools import wraps
 from urllib.request import urlopen
 from flask import request
-from jose import jwt
+from jose import jwt, jwk
+from jose.utils import base64url_decode
+from metrics import phase, registry
+from limits import admission, limiter
+from singleflight import count
 
-AUTH0_DOMAIN = 'diyorbek.us.auth0.com'
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'diyorbek.us.auth0.com')
 API_AUDIENCE = 'casting'
 ALGORITMS = ['RS256']
 
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# used when Auth0 does not send a Cache-Control max-age
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+# an unknown kid triggers at most one refetch per interval
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_TIMEOUT = float(os.environ.get('JWKS_TIMEOUT', 5))
+# number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# bearer token of /metrics and /internal/pool, which answer 401 to everyone while it is unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
 
 class AuthError(Exception):
     def __init__(self, status_code, description):
@@ -16,8 +39,139 @@ class AuthError(Exception):
         self.description = description
 
 
+class JWKSCache:
+    """Process-wide store of parsed JWKS signing keys, shared by all threads."""
+
+    def __init__(self, url, ttl=JWKS_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_TIMEOUT, name='jwks'):
+        self.url = url
+        self.name = name
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._expires_at = 0
+        self._last_refresh = None
+        self._refreshed_at = None
+        self._refresh_lock = threading.Lock()
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None and time.monotonic() < self._expires_at:
+            self._count('hit')
+            return key
+        self._count('miss')
+        self.refresh(kid)
+        return self._keys.get(kid, key)
+
+    def refresh(self, kid=None):
+        started = time.monotonic()
+        with self._refresh_lock:
+            now = time.monotonic()
+            # another thread refreshed while we waited for the lock
+            if self._refreshed_at is not None and self._refreshed_at >= started:
+                count('jwks', 'coalesced')
+                return
+            expired = now >= self._expires_at
+            recently = (self._last_refresh is not None
+                        and now - self._last_refresh < self.min_refresh_interval)
+            if not expired and (kid in self._keys or recently):
+                return
+            self._last_refresh = now
+            count('jwks', 'leader')
+            try:
+                jwks, max_age = self.fetch()
+                keys = self.build_keys(jwks)
+            except Exception:
+                # keep serving the keys we have, retry after the backoff
+                self._count('refresh_failure')
+                self._expires_at = now + self.min_refresh_interval
+                return
+            finally:
+                self._refreshed_at = time.monotonic()
+            self._keys = keys
+            self._expires_at = now + (self.ttl if max_age is None else max_age)
+            self._count('refresh')
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            match = MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+            jwks = json.loads(response.read())
+        return jwks, int(match.group(1)) if match else None
+
+    def build_keys(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            algorithm = key.get('alg', ALGORITMS[0])
+            if algorithm not in ALGORITMS:
+                continue
+            keys[key['kid']] = jwk.construct(key, algorithm)
+        return keys
+
+    def clear(self):
+        with self._refresh_lock:
+            self._keys = {}
+            self._expires_at = 0
+            self._last_refresh = None
+
+    def _count(self, event):
+        registry.inc('cache_events_total', (('cache', self.name), ('event', event)))
+
+
+class TokenCache:
+    """Bounded LRU of verified token payloads, each kept until the token's exp."""
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, name='token'):
+        self.maxsize = maxsize
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        if not self.maxsize: return None
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self._count('miss')
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                self._count('miss')
+                return None
+            self._entries.move_to_end(digest)
+            self._count('hit')
+            return payload
+
+    def put(self, token, payload):
+        if not self.maxsize or 'exp' not in payload: return
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[digest] = (payload, payload['exp'])
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._count('eviction')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _count(self, event):
+        registry.inc('cache_events_total', (('cache', self.name), ('event', event)))
+
+
+jwks = JWKSCache(JWKS_URL)
+token_cache = TokenCache()
+
+
 def get_token_auth_header():
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+def parse_auth_header(auth):
     if auth is None:
         raise AuthError(401, 'authorization header excepted')
     
@@ -29,56 +183,77 @@ def get_token_auth_header():
     return parts[1]
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_token = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     if 'kid' not in unverified_token: raise AuthError(401, 'authorization malformed')
+    if unverified_token.get('alg') not in ALGORITMS: raise AuthError(401, 'authorization malformed')
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_token['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITMS,
-                audience=API_AUDIENCE,
-                issuer=f'https://{AUTH0_DOMAIN}/'
-            )
-            
-            return payload
-        
-        except jwt.ExpiredSignatureError:
-            raise AuthError(401, 'jwt token expired')
-        except jwt.JWTClaimsError:
-            raise AuthError(401, 'invalid claims')
-        
-        except Exception: raise AuthError(400, 'unable to parse authorization token')
+    rsa_key = jwks.get_key(unverified_token['kid'])
+    if rsa_key is None: raise AuthError(401, 'unable to find the appropriate key')
+
+    signing_input, _, signature = token.rpartition('.')
+    if not rsa_key.verify(signing_input.encode(), base64url_decode(signature.encode())):
+        raise AuthError(401, 'invalid signature')
+
+    try:
+        # the signature was checked above with the prebuilt key
+        payload = jwt.decode(
+            token,
+            '',
+            algorithms=ALGORITMS,
+            audience=API_AUDIENCE,
+            issuer=f'https://{AUTH0_DOMAIN}/',
+            options={'verify_signature': False}
+        )
+        if 'permissions' in payload:
+            payload['permissions'] = frozenset(payload['permissions'])
+
+        return payload
+
+    except jwt.ExpiredSignatureError:
+        raise AuthError(401, 'jwt token expired')
+    except jwt.JWTClaimsError:
+        raise AuthError(401, 'invalid claims')
+
+    except Exception: raise AuthError(400, 'unable to parse authorization token')
 
 def check_permissions(permission, payload):
     if 'permissions' not in payload: raise AuthError(400, 'permission not included in jwt')
     if permission not in payload['permissions']: raise AuthError(401, 'permission not found')
     return True
 
+def verify_token(token):
+    """Verify a token that is not in the token cache and cache its payload."""
+    try:
+        payload = verify_decode_jwt(token)
+    except: raise AuthError(401, 'jwt not verified')
+    token_cache.put(token, payload)
+    return payload
+
+def check_metrics_token(auth):
+    token = parse_auth_header(auth)
+    if not METRICS_TOKEN or not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        raise AuthError(401, 'metrics token not valid')
+
+def requires_metrics_token(f):
+    """Let only scrapers with METRICS_TOKEN see the internals of the workers."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        check_metrics_token(request.headers.get('Authorization', None))
+        return f(*args, **kwargs)
+    return wrapper
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except: raise AuthError(401, 'jwt not verified')
-            check_permissions(permission, payload)
-            return f(*args, **kwargs)
+            with admission.admit():
+                with phase('auth'):
+                    token = get_token_auth_header()
+                    payload = token_cache.get(token)
+                    if payload is None: payload = verify_token(token)
+                    check_permissions(permission, payload)
+                    limiter.check(permission, payload)
+                return f(*args, **kwargs)
         return wrapper
     return requires_auth_decorator
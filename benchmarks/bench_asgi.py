@@ -0,0 +1,92 @@
+"""Compare the throughput of the sync and the async deployment.
+
+Starts ``gunicorn app:app`` and ``uvicorn asgi:app`` with the same number
+of workers against the same database and drives both with the same mix of
+GET /actors/<id> and GET /actors?after=<id> requests.
+
+    python benchmarks/bench_asgi.py --rows 10000 --requests 5000 --concurrency 64
+
+Seeds a throwaway SQLite database unless DATABASE_URL is set; async SQLite
+needs SQLAlchemy >= 1.4.3 with aiosqlite, Postgres needs asyncpg. The read
+cache is disabled so every request reaches the database, and tokens come
+from a local JWKS server (``--jwks-delay`` simulates a slow tenant).
+"""
+import os
+import sys
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkstemp(suffix=".sqlite")[1]}')
+
+from sqlalchemy import insert  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Actor  # noqa: E402
+from local_auth import LocalAuth  # noqa: E402
+from loadgen import drive, free_port, percentile, start  # noqa: E402
+
+
+def seed(rows, chunk=10000):
+    db.session.execute(Actor.__table__.delete())
+    for start in range(0, rows, chunk):
+        db.session.execute(insert(Actor.__table__), [
+            {'name': f'actor {start + i}', 'age': random.randint(18, 90), 'gender': random.choice(['male', 'female'])}
+            for i in range(min(chunk, rows - start))
+        ])
+    db.session.commit()
+
+
+def load(port, paths, concurrency, token):
+    requests = [('GET', 'GET', path, {'Authorization': f'Bearer {token()}'}, None) for path in paths]
+    results, elapsed = asyncio.run(drive(port, requests, concurrency))
+    timings = sorted(ms for _, _, ms in results)
+    errors = sum(status != 200 for _, status, _ in results)
+    return len(results) / elapsed, percentile(timings, 50), percentile(timings, 95), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--jwks-delay', type=float, default=0)
+    parser.add_argument('--fresh-tokens', action='store_true', help='sign a new token for every request')
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(1)
+    with app.app_context():
+        db.create_all()
+        if not args.skip_seed: seed(args.rows)
+        ids = [row.id for row in db.session.query(Actor.id)]
+    auth = LocalAuth(args.jwks_delay)
+    env = dict(os.environ, READ_CACHE_SIZE='0', RATE_LIMITS='', **auth.env())
+    shared = auth.token()
+    token = auth.token if args.fresh_tokens else lambda: shared
+
+    servers = (
+        ('gunicorn app:app', [sys.executable, '-m', 'gunicorn.app.wsgiapp', '--workers', str(args.workers),
+                              '--bind', '127.0.0.1:{port}', 'app:app']),
+        ('uvicorn asgi:app', [sys.executable, '-m', 'uvicorn', '--workers', str(args.workers),
+                              '--host', '127.0.0.1', '--port', '{port}', '--no-access-log', 'asgi:app'])
+    )
+    print(f'{len(ids)} actors, {args.requests} requests, concurrency {args.concurrency}, {args.workers} workers')
+    for label, argv in servers:
+        port = free_port()
+        process = start([arg.format(port=port) for arg in argv], env, port)
+        try:
+            paths = [random.choice((f'/actors/{random.choice(ids)}', f'/actors?after={random.choice(ids[:-1])}'))
+                     for _ in range(args.requests)]
+            rps, p50, p95, errors = load(port, paths, args.concurrency, token)
+        finally:
+            process.terminate()
+            process.wait()
+        print(f'{label:>18}: {rps:8.1f} req/s  p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  errors {errors}')
+    auth.close()
+
+
+if __name__ == '__main__':
+    main()
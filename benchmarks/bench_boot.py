@@ -0,0 +1,73 @@
+"""Measure the cold start of a gunicorn worker.
+
+Starts ``gunicorn app:app`` with one worker several times and reports the
+median time until the server answers ``GET /`` and until the first
+authenticated ``GET /actors`` returns, which includes the JWKS fetch and
+the first database connection unless the worker warmed them up.
+
+    python benchmarks/bench_boot.py --runs 5 --jwks-delay 0.2
+    WARMUP=true python benchmarks/bench_boot.py --preload
+
+Uses a throwaway SQLite database unless DATABASE_URL is set.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkstemp(suffix=".sqlite")[1]}')
+
+from app import app, db  # noqa: E402
+from local_auth import LocalAuth  # noqa: E402
+from loadgen import drive, free_port, start  # noqa: E402
+
+
+def boot(argv, env, port, token):
+    """Seconds until the server accepts, answers / and answers an authenticated GET /actors."""
+    started = time.perf_counter()
+    process = start(argv, env, port, timeout=60)
+    try:
+        accepted = time.perf_counter() - started
+        while True:
+            results, _ = asyncio.run(drive(port, [('/', 'GET', '/', {}, None)], 1))
+            if results[0][1] == 200: break
+        ready = time.perf_counter() - started
+        asyncio.run(drive(port, [('/actors', 'GET', '/actors', {'Authorization': f'Bearer {token}'}, None)], 1))
+        first = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+    return accepted, ready, first
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--jwks-delay', type=float, default=0, help='seconds added to each JWKS fetch')
+    parser.add_argument('--preload', action='store_true', help='load the app in the master before forking')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+    auth = LocalAuth(args.jwks_delay)
+    token = auth.token('assistant')
+    env = dict(os.environ, **auth.env())
+    timings = []
+    for _ in range(args.runs):
+        port = free_port()
+        argv = [sys.executable, '-m', 'gunicorn.app.wsgiapp', '--workers', '1', '--bind', f'127.0.0.1:{port}']
+        if args.preload: argv.append('--preload')
+        timings.append(boot(argv + ['app:app'], env, port, token))
+    auth.close()
+
+    for label, values in zip(('accepting', 'GET / answered', 'first GET /actors'), zip(*timings)):
+        print(f'{label:>18}: median {statistics.median(values) * 1000:8.1f} ms  '
+              f'max {max(values) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
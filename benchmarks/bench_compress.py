@@ -0,0 +1,103 @@
+"""CPU cost against bytes saved of response compression at each level.
+
+    python benchmarks/bench_compress.py --rows 10000 --per-page 100
+
+Compresses real bodies of the API, a JSON list page, the same page with
+``include=cast`` and the NDJSON and CSV exports of the actors, with gzip
+at levels 1, 3, 6 and 9 and, when the ``brotli`` package is installed,
+brotli at qualities 1, 4, 6 and 11. Prints the compressed size as a share
+of the original and the milliseconds and MB/s of one compression.
+
+Seeds a throwaway SQLite database unless DATABASE_URL is set.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkstemp(suffix=".sqlite")[1]}')
+
+from sqlalchemy import insert  # noqa: E402
+from werkzeug.datastructures import MultiDict  # noqa: E402
+import resources  # noqa: E402
+from app import app, db  # noqa: E402
+from compression import brotli, compress  # noqa: E402
+from models import Actor, Movie  # noqa: E402
+
+LEVELS = [('gzip', level) for level in (1, 3, 6, 9)] + ([('br', quality) for quality in (1, 4, 6, 11)]
+                                                       if brotli else [])
+
+
+def seed(rows, chunk=10000):
+    db.session.execute(Actor.__table__.delete())
+    db.session.execute(Movie.__table__.delete())
+    for start in range(0, rows, chunk):
+        db.session.execute(insert(Actor.__table__), [
+            {'name': f'actor {start + i}', 'age': random.randint(18, 90), 'gender': random.choice(['male', 'female'])}
+            for i in range(min(chunk, rows - start))
+        ])
+    db.session.commit()
+    actors = [row.id for row in db.session.query(Actor.id).limit(1000)]
+    movies = Movie.bulk_add([{'title': f'movie {i}', 'release_date': date(1950, 1, 1) + timedelta(days=i)}
+                             for i in range(200)])
+    for movie_id in movies:
+        Movie.replace_cast(movie_id, [{'actor_id': id, 'role': f'role of {id}'} for id in random.sample(actors, 8)])
+
+
+def bodies(per_page):
+    """(label, bytes) of the payloads worth compressing."""
+    def page(model, name, **args):
+        rows, _ = resources.paginate(db.session, model, MultiDict(dict(args, per_page=per_page)), [], [model.id],
+                                     ('id',) + model.fields)
+        return resources.dumps({'success': True, name: rows})
+
+    def export(export_format):
+        _, names, stmt = resources.export_query(Actor, MultiDict({'format': export_format}))
+        encoder = resources.ExportEncoder(export_format, names)
+        rows = db.session.execute(stmt).all()
+        return (encoder.header() + encoder.encode(rows)).encode()
+
+    return [(f'GET /actors {per_page}', page(Actor, 'actors')),
+            (f'GET /movies {per_page} cast', page(Movie, 'movies', include='cast')),
+            ('export ndjson', export('ndjson')),
+            ('export csv', export('csv'))]
+
+
+def measure(body, encoding, level, seconds):
+    started, runs = time.perf_counter(), 0
+    while True:
+        compressed = compress(body, encoding, level)
+        runs += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds: return len(compressed), elapsed / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=0.5, help='time spent on each body and level')
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(1)
+    resources.MAX_PER_PAGE = max(resources.MAX_PER_PAGE, args.per_page)
+    with app.test_request_context():
+        db.create_all()
+        if not args.skip_seed: seed(args.rows)
+        payloads = bodies(args.per_page)
+    print(f'brotli {"installed" if brotli else "missing"}')
+    print(f'{"body":<22} {"bytes":>10} {"encoding":>9} {"level":>5} {"size %":>7} {"ms":>9} {"MB/s":>8}')
+    for label, body in payloads:
+        for encoding, level in LEVELS:
+            size, seconds = measure(body, encoding, level, args.seconds)
+            print(f'{label:<22} {len(body):>10} {encoding:>9} {level:>5} {size / len(body) * 100:>6.1f}% '
+                  f'{seconds * 1000:>9.3f} {len(body) / seconds / 1e6:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
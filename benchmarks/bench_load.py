@@ -0,0 +1,238 @@
+"""Load test every endpoint of the API offline and check for regressions.
+
+Seeds actors and movies, starts the server with tokens checked against a
+local JWKS server, sends a weighted mix of requests to every endpoint from
+concurrent connections and prints throughput and p50/p95/p99 per endpoint.
+Each request uses the least privileged role allowed to make it.
+
+    python benchmarks/bench_load.py --actors 10000 --movies 10000 --requests 5000
+    python benchmarks/bench_load.py --save baseline.json
+    python benchmarks/bench_load.py --compare baseline.json --threshold 0.15
+
+Seeds a throwaway SQLite database unless DATABASE_URL is set, e.g. to a
+local Postgres. ``--compare`` exits with status 1 when the throughput or the
+p95 of any endpoint is more than ``--threshold`` worse than the baseline.
+"""
+import os
+import sys
+import json
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import date, timedelta
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkstemp(suffix=".sqlite")[1]}')
+
+from sqlalchemy import insert  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Actor, Movie  # noqa: E402
+from local_auth import LocalAuth  # noqa: E402
+from loadgen import drive, free_port, percentile, start  # noqa: E402
+
+SERVERS = {
+    'gunicorn': ['-m', 'gunicorn.app.wsgiapp', '--workers', '{workers}', '--bind', '127.0.0.1:{port}', 'app:app'],
+    'uvicorn': ['-m', 'uvicorn', '--workers', '{workers}', '--host', '127.0.0.1', '--port', '{port}',
+                '--no-access-log', 'asgi:app']
+}
+
+
+def seed(actors, movies, chunk=10000):
+    db.session.execute(Actor.__table__.delete())
+    db.session.execute(Movie.__table__.delete())
+    for start in range(0, actors, chunk):
+        db.session.execute(insert(Actor.__table__), [
+            {'name': f'actor {start + i}', 'age': random.randint(18, 90), 'gender': random.choice(['male', 'female'])}
+            for i in range(min(chunk, actors - start))
+        ])
+    for start in range(0, movies, chunk):
+        db.session.execute(insert(Movie.__table__), [
+            {'title': f'movie {start + i}', 'release_date': date(1950, 1, 1) + timedelta(days=random.randint(0, 27000))}
+            for i in range(min(chunk, movies - start))
+        ])
+    db.session.commit()
+
+
+class Workload:
+    """Generates the requests of each endpoint against the seeded ids.
+
+    The upper fifth of the ids is reserved for deletes, so reads and
+    updates always find their row.
+    """
+
+    def __init__(self, ids):
+        self.ids, self.deletable = {}, {}
+        for name, table_ids in ids.items():
+            cut = len(table_ids) * 4 // 5
+            self.ids[name], self.deletable[name] = table_ids[:cut], table_ids[cut:]
+
+    def id(self, name):
+        return random.choice(self.ids[name])
+
+    def delete_id(self, name):
+        return self.deletable[name].pop() if self.deletable[name] else 0
+
+    def actor(self):
+        return {'name': f'actor {uuid.uuid4().hex[:8]}', 'age': random.randint(18, 90),
+                'gender': random.choice(['male', 'female'])}
+
+    def movie(self):
+        return {'title': f'movie {uuid.uuid4().hex}',
+                'release_date': (date(1950, 1, 1) + timedelta(days=random.randint(0, 27000))).isoformat()}
+
+    def scenarios(self):
+        """(endpoint, weight, role, request factory returning method, path, body)."""
+        return [
+            ('GET /actors', 10, 'assistant', lambda: ('GET', f'/actors?page={random.randint(1, 20)}', None)),
+            ('GET /actors?after', 10, 'assistant', lambda: ('GET', f'/actors?after={self.id("actors")}', None)),
+            ('GET /actors?filter', 5, 'assistant',
+             lambda: ('GET', f'/actors?gender=female&age_min={random.randint(18, 60)}&sort=-age', None)),
+            ('GET /actors/search', 5, 'assistant',
+             lambda: ('GET', f'/actors/search?q={quote(f"actor {random.randint(1, 99)}")}', None)),
+            ('GET /actors/<id>', 20, 'assistant', lambda: ('GET', f'/actors/{self.id("actors")}', None)),
+            ('POST /actors', 3, 'director', lambda: ('POST', '/actors', self.actor())),
+            ('PATCH /actors/<id>', 3, 'director',
+             lambda: ('PATCH', f'/actors/{self.id("actors")}', {'age': random.randint(18, 90)})),
+            ('DELETE /actors/<id>', 1, 'director', lambda: ('DELETE', f'/actors/{self.delete_id("actors")}', None)),
+            ('POST /actors/batch', 1, 'director',
+             lambda: ('POST', '/actors/batch', [self.actor() for _ in range(20)])),
+            ('PATCH /actors/batch', 1, 'director', lambda: ('PATCH', '/actors/batch', [
+                {'id': self.id('actors'), 'age': random.randint(18, 90)} for _ in range(20)])),
+            ('DELETE /actors/batch', 1, 'director',
+             lambda: ('DELETE', '/actors/batch', [self.delete_id('actors') for _ in range(5)])),
+            ('GET /movies', 10, 'assistant', lambda: ('GET', f'/movies?page={random.randint(1, 20)}', None)),
+            ('GET /movies?released', 5, 'assistant',
+             lambda: ('GET', '/movies?released_from=1990-01-01&sort=-release_date', None)),
+            ('GET /movies/search', 5, 'assistant',
+             lambda: ('GET', f'/movies/search?q={quote(f"movie {random.randint(1, 99)}")}', None)),
+            ('GET /movies/<id>', 20, 'assistant', lambda: ('GET', f'/movies/{self.id("movies")}', None)),
+            ('POST /movies', 3, 'producer', lambda: ('POST', '/movies', self.movie())),
+            ('PATCH /movies/<id>', 3, 'director',
+             lambda: ('PATCH', f'/movies/{self.id("movies")}', {'title': f'movie {uuid.uuid4().hex}'})),
+            ('DELETE /movies/<id>', 1, 'producer', lambda: ('DELETE', f'/movies/{self.delete_id("movies")}', None)),
+            ('POST /movies/batch', 1, 'producer',
+             lambda: ('POST', '/movies/batch', [self.movie() for _ in range(20)])),
+            ('PATCH /movies/batch', 1, 'director', lambda: ('PATCH', '/movies/batch', [
+                {'id': self.id('movies'), 'title': f'movie {uuid.uuid4().hex}'} for _ in range(20)])),
+            ('DELETE /movies/batch', 1, 'producer',
+             lambda: ('DELETE', '/movies/batch', [self.delete_id('movies') for _ in range(5)])),
+            ('GET /actors/export', 1, 'assistant', lambda: ('GET', '/actors/export', None)),
+            ('GET /movies/export', 1, 'assistant', lambda: ('GET', '/movies/export?format=csv', None))
+        ]
+
+    def requests(self, count, tokens):
+        scenarios = self.scenarios()
+        chosen = random.choices(scenarios, weights=[weight for _, weight, _, _ in scenarios], k=count)
+        requests = []
+        for name, _, role, factory in chosen:
+            method, path, body = factory()
+            requests.append((name, method, path, {'Authorization': f'Bearer {random.choice(tokens[role])}'}, body))
+        return requests
+
+
+def summarize(results, elapsed):
+    """Throughput and latency percentiles, overall and per endpoint."""
+    endpoints = {}
+    for name, status, ms in results:
+        endpoint = endpoints.setdefault(name, {'timings': [], 'errors': 0})
+        endpoint['timings'].append(ms)
+        # a delete may run out of reserved ids, which is a 404 and not an error
+        if status >= 500 or status in (401, 403) or status == 404 and not name.startswith('DELETE'):
+            endpoint['errors'] += 1
+    summary = {'throughput': len(results) / elapsed, 'endpoints': {}}
+    for name, endpoint in sorted(endpoints.items()):
+        timings = sorted(endpoint['timings'])
+        summary['endpoints'][name] = {
+            'requests': len(timings),
+            'errors': endpoint['errors'],
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+            'p99': percentile(timings, 99)
+        }
+    return summary
+
+
+def report(summary):
+    print(f'{"endpoint":<24} {"requests":>8} {"errors":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for name, endpoint in summary['endpoints'].items():
+        print(f'{name:<24} {endpoint["requests"]:>8} {endpoint["errors"]:>6} '
+              f'{endpoint["p50"]:>9.2f} {endpoint["p95"]:>9.2f} {endpoint["p99"]:>9.2f}')
+    print(f'throughput {summary["throughput"]:.1f} req/s')
+
+
+def regressions(summary, baseline, threshold):
+    """Describe each endpoint whose p95, and the run whose throughput, got worse than allowed."""
+    found = []
+    if summary['throughput'] < baseline['throughput'] * (1 - threshold):
+        found.append(f'throughput {baseline["throughput"]:.1f} -> {summary["throughput"]:.1f} req/s')
+    for name, endpoint in summary['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before and endpoint['p95'] > before['p95'] * (1 + threshold):
+            found.append(f'{name} p95 {before["p95"]:.2f} -> {endpoint["p95"]:.2f} ms')
+        if endpoint['errors']:
+            found.append(f'{name} {endpoint["errors"]} errors')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--server', choices=SERVERS, default='gunicorn')
+    parser.add_argument('--tokens', type=int, default=1, help='distinct tokens per role')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the data and the request mix')
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--save', metavar='FILE', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='fail if the results regressed from this baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed fraction of regression')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with app.app_context():
+        db.create_all()
+        if not args.skip_seed: seed(args.actors, args.movies)
+        ids = {'actors': [row.id for row in db.session.query(Actor.id).order_by(Actor.id)],
+               'movies': [row.id for row in db.session.query(Movie.id).order_by(Movie.id)]}
+    auth = LocalAuth()
+    tokens = {role: [auth.token(role, subject=f'auth0|{role}{i}') for i in range(args.tokens)]
+              for role in ('assistant', 'director', 'producer')}
+    requests = Workload(ids).requests(args.requests, tokens)
+
+    port = free_port()
+    argv = [sys.executable] + [arg.format(port=port, workers=args.workers) for arg in SERVERS[args.server]]
+    # measure the database and not the read cache or the rate limits
+    process = start(argv, dict(os.environ, READ_CACHE_SIZE='0', RATE_LIMITS='', **auth.env()), port)
+    try:
+        results, elapsed = asyncio.run(drive(port, requests, args.concurrency))
+    finally:
+        process.terminate()
+        process.wait()
+        auth.close()
+
+    summary = summarize(results, elapsed)
+    summary['settings'] = {key: getattr(args, key) for key in ('actors', 'movies', 'requests', 'concurrency',
+                                                                 'workers', 'server', 'tokens', 'seed')}
+    print(f'{len(ids["actors"])} actors, {len(ids["movies"])} movies, {args.server} with {args.workers} workers, '
+          f'concurrency {args.concurrency}')
+    report(summary)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != summary['settings']:
+            print(f'warning: the baseline was measured with {baseline.get("settings")}')
+        found = regressions(summary, baseline, args.threshold)
+        for line in found: print(f'REGRESSION {line}')
+        if found: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
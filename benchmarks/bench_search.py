@@ -0,0 +1,84 @@
+"""Compare GET /actors/search against paging through GET /actors and
+filtering on the client, which is how the casting UI does type-ahead today.
+
+    python benchmarks/bench_search.py --rows 1000000 --queries 50
+
+Seeds a throwaway SQLite database unless DATABASE_URL is set.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkstemp(suffix=".sqlite")[1]}')
+
+from sqlalchemy import insert  # noqa: E402
+from app import app, db, COUNT_PER_PAGE  # noqa: E402
+from models import Actor  # noqa: E402
+from search import search  # noqa: E402
+
+SYLLABLES = ['jo', 'an', 'na', 'mi', 'ka', 'el', 'ro', 'sa', 'li', 'da', 'ter', 'son', 'ber', 'ly', 'vic']
+
+
+def name():
+    word = lambda: ''.join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))).title()
+    return f'{word()} {word()}'
+
+
+def seed(rows, chunk=10000):
+    db.session.execute(Actor.__table__.delete())
+    for start in range(0, rows, chunk):
+        db.session.execute(insert(Actor.__table__), [
+            {'name': name(), 'age': random.randint(18, 90), 'gender': random.choice(['male', 'female'])}
+            for _ in range(min(chunk, rows - start))
+        ])
+    db.session.commit()
+
+
+def paginate_and_filter(prefix, limit):
+    """Fetch pages of COUNT_PER_PAGE until ``limit`` names start with ``prefix``."""
+    matches, page = [], 0
+    while len(matches) < limit:
+        rows = Actor.query.order_by(Actor.id).offset(page * COUNT_PER_PAGE).limit(COUNT_PER_PAGE).all()
+        if not rows: break
+        matches += [row for row in rows if row.name.lower().startswith(prefix)]
+        page += 1
+    return matches[:limit]
+
+
+def measure(fn, queries, limit):
+    timings = []
+    for prefix in queries:
+        started = time.perf_counter()
+        fn(prefix, limit)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(1)
+    with app.app_context():
+        db.create_all()
+        if not args.skip_seed: seed(args.rows)
+        queries = [random.choice(SYLLABLES) + random.choice(SYLLABLES)[:1] for _ in range(args.queries)]
+        print(f'{Actor.query.count()} actors, {args.queries} prefix queries, limit {args.limit}')
+        for label, fn in (('search', lambda q, limit: search(Actor, q, limit)),
+                          ('paginate+filter', paginate_and_filter)):
+            p50, p95 = measure(fn, queries, args.limit)
+            print(f'{label:>16}: p50 {p50:8.2f} ms  p95 {p95:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
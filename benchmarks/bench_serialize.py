@@ -0,0 +1,104 @@
+"""Rows per second of the list serialization paths, from the query to JSON bytes.
+
+    python benchmarks/bench_serialize.py --rows 100000 --per-page 100
+
+Every path reads keyset pages (``?after=<id>``), so the numbers compare
+serialization and not OFFSET scans.
+
+``orm+jsonify`` hydrates Actor objects, builds a dict per row with
+``format()`` and encodes with Flask's ``jsonify``. ``columns+jsonify`` queries
+the columns through the ORM as GET /actors did before. ``tuples+dumps`` is
+the current path: plain row tuples from a Core SELECT encoded by
+``resources.dumps`` with orjson, and ``tuples+json`` the same with the
+standard library encoder, as when orjson is not installed.
+
+Seeds a throwaway SQLite database unless DATABASE_URL is set.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkstemp(suffix=".sqlite")[1]}')
+
+from flask import jsonify  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from werkzeug.datastructures import MultiDict  # noqa: E402
+import resources  # noqa: E402
+from app import app, db  # noqa: E402
+from models import Actor  # noqa: E402
+
+
+def seed(rows, chunk=10000):
+    db.session.execute(Actor.__table__.delete())
+    for start in range(0, rows, chunk):
+        db.session.execute(insert(Actor.__table__), [
+            {'name': f'actor {start + i}', 'age': random.randint(18, 90), 'gender': random.choice(['male', 'female'])}
+            for i in range(min(chunk, rows - start))
+        ])
+    db.session.commit()
+
+
+def orm_jsonify(after, per_page):
+    rows = Actor.query.filter(Actor.id > after).order_by(Actor.id).limit(per_page + 1).all()
+    return jsonify({'success': True, 'actors': [row.format() for row in rows[:per_page]]}).get_data()
+
+
+def columns_jsonify(after, per_page):
+    fields = ('id',) + Actor.fields
+    rows = (db.session.query(*[getattr(Actor, name) for name in fields]).filter(Actor.id > after)
+            .order_by(Actor.id).limit(per_page + 1).all())
+    return jsonify({'success': True, 'actors': [{name: getattr(row, name) for name in fields}
+                                                for row in rows[:per_page]]}).get_data()
+
+
+def tuples_dumps(after, per_page):
+    args = MultiDict({'after': after, 'per_page': per_page})
+    rows, _ = resources.paginate(db.session, Actor, args, [], [Actor.id], ('id',) + Actor.fields)
+    return resources.dumps({'success': True, 'actors': rows})
+
+
+def tuples_json(after, per_page):
+    orjson, resources.orjson = resources.orjson, None
+    try:
+        return tuples_dumps(after, per_page)
+    finally:
+        resources.orjson = orjson
+
+
+def measure(fn, cursors, per_page):
+    started = time.perf_counter()
+    for after in cursors:
+        fn(after, per_page)
+        db.session.remove()
+    return len(cursors) * per_page / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(1)
+    # let the current path return pages as large as the others
+    resources.MAX_PER_PAGE = max(resources.MAX_PER_PAGE, args.per_page)
+    with app.test_request_context():
+        db.create_all()
+        if not args.skip_seed: seed(args.rows)
+        cursors = [random.randint(0, args.rows - args.per_page) for _ in range(args.pages)]
+        print(f'{Actor.query.count()} actors, {args.pages} pages of {args.per_page}, '
+              f'orjson {"installed" if resources.orjson else "missing"}')
+        for label, fn in (('orm+jsonify', orm_jsonify), ('columns+jsonify', columns_jsonify),
+                          ('tuples+dumps', tuples_dumps), ('tuples+json', tuples_json)):
+            fn(0, args.per_page)
+            print(f'{label:>16}: {measure(fn, cursors, args.per_page):10.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Start a server in a subprocess and drive it with concurrent HTTP requests.
+
+The client speaks just enough HTTP/1.1 for the API: keep-alive connections,
+Content-Length and chunked bodies, reconnecting when the server closes.
+"""
+import os
+import time
+import json
+import socket
+import asyncio
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(argv, env, port, timeout=30):
+    """Run ``argv`` from the repository root and wait until ``port`` accepts connections."""
+    process = subprocess.Popen(argv, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None: break
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{argv[0]} did not start')
+
+
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    length, chunked, close = 0, False, False
+    while True:
+        line = (await reader.readline()).strip().lower()
+        if not line: break
+        if line.startswith(b'content-length:'): length = int(line.split(b':')[1])
+        elif line == b'transfer-encoding: chunked': chunked = True
+        elif line == b'connection: close': close = True
+    if not chunked:
+        return status, await reader.readexactly(length), close
+    body = b''
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        body += await reader.readexactly(size + 2)
+        if size == 0: return status, body, close
+
+
+async def client(port, requests, results):
+    """Send requests over one keep-alive connection until ``requests`` is empty.
+
+    Each request is ``(name, method, path, headers, body)``; the result is
+    ``(name, status, milliseconds)``.
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while requests:
+            name, method, path, headers, body = requests.pop()
+            data = b'' if body is None else json.dumps(body).encode()
+            head = f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n'
+            if body is not None: head += 'Content-Type: application/json\r\n'
+            head += ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+            started = time.perf_counter()
+            writer.write(head.encode() + b'\r\n' + data)
+            status, _, close = await read_response(reader)
+            results.append((name, status, (time.perf_counter() - started) * 1000))
+            if close:
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    finally:
+        writer.close()
+
+
+async def drive(port, requests, concurrency):
+    """Send all requests with ``concurrency`` connections; return results and seconds taken."""
+    results = []
+    requests = list(reversed(requests))
+    started = time.perf_counter()
+    await asyncio.gather(*[client(port, requests, results) for _ in range(concurrency)])
+    return results, time.perf_counter() - started
+
+
+def percentile(timings, q):
+    """The q-th percentile of sorted timings."""
+    return timings[min(len(timings) - 1, max(0, int(round(q / 100 * len(timings))) - 1))]
@@ -0,0 +1,66 @@
+"""A local stand-in for the Auth0 tenant, so benchmarks run offline.
+
+Serves a freshly generated RSA key as a JWKS over HTTP and signs tokens with
+it. Point a server at it with the variables from ``LocalAuth.env()``.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import API_AUDIENCE, AUTH0_DOMAIN  # noqa: E402
+
+KID = 'bench'
+# permissions of the Auth0 roles of the casting agency
+ROLES = {
+    'assistant': ['get:actors', 'get:movies'],
+    'director': ['get:actors', 'post:actors', 'patch:actors', 'delete:actors', 'get:movies', 'patch:movies'],
+    'producer': ['get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+                 'get:movies', 'post:movies', 'patch:movies', 'delete:movies']
+}
+
+
+class LocalAuth:
+    """JWKS endpoint on 127.0.0.1; ``delay`` seconds are added to each fetch."""
+
+    def __init__(self, delay=0):
+        public, self.private = rsa.newkeys(2048)
+        jwks = json.dumps({'keys': [{
+            'kty': 'RSA', 'kid': KID, 'use': 'sig', 'alg': 'RS256',
+            'n': long_to_base64(public.n).decode(), 'e': long_to_base64(public.e).decode()
+        }]}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(jwks)))
+                self.end_headers()
+                self.wfile.write(jwks)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/.well-known/jwks.json'
+
+    def env(self):
+        return {'JWKS_URL': self.url, 'AUTH0_DOMAIN': AUTH0_DOMAIN}
+
+    def token(self, role='producer', exp=3600, subject=None):
+        now = int(time.time())
+        claims = {'iss': f'https://{AUTH0_DOMAIN}/', 'sub': subject or f'auth0|{role}', 'aud': API_AUDIENCE,
+                  'iat': now, 'exp': now + exp, 'permissions': ROLES[role]}
+        return jwt.encode(claims, self.private.save_pkcs1().decode(), algorithm='RS256', headers={'kid': KID})
+
+    def close(self):
+        self.server.shutdown()
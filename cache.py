@@ -0,0 +1,200 @@
+import os
+import time
+import pickle
+import threading
+from collections import OrderedDict
+from metrics import registry
+
+READ_CACHE_SIZE = int(os.environ.get('READ_CACHE_SIZE', 10000))
+READ_CACHE_TTL = int(os.environ.get('READ_CACHE_TTL', 30))
+# redis:// URL of a cache shared by all workers, the default is per process
+READ_CACHE_URL = os.environ.get('READ_CACHE_URL', None)
+
+
+class MemoryBackend:
+    """Size-bounded LRU with a TTL per entry, local to the process."""
+
+    def __init__(self, maxsize=READ_CACHE_SIZE, ttl=READ_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # counters live outside the LRU so they are never evicted
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def set_if(self, key, value, counter_key, expected, ttl=None):
+        """Set ``key`` only while the counter ``counter_key`` is still ``expected``."""
+        with self._lock:
+            if self._counters.get(counter_key, 0) == expected: self._store(key, value, ttl)
+
+    def _store(self, key, value, ttl):
+        if not self.maxsize: return
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedBackend:
+    """Cache kept in a store shared by all workers.
+
+    ``client`` needs the redis-py ``get``/``set(ex=)``/``delete``/``incr``
+    and ``transaction`` methods, so a ``redis.Redis`` instance or
+    :class:`LocalClient` works.
+    """
+
+    def __init__(self, client, ttl=READ_CACHE_TTL, prefix='casting:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl if ttl is None else ttl)
+
+    def set_if(self, key, value, counter_key, expected, ttl=None):
+        """Set ``key`` only while the counter ``counter_key`` is still ``expected``, with WATCH/MULTI."""
+        counter_key = self.prefix + counter_key
+
+        def store(pipe):
+            if int(pipe.get(counter_key) or 0) != expected: return
+            pipe.multi()
+            pipe.set(self.prefix + key, pickle.dumps(value), ex=self.ttl if ttl is None else ttl)
+
+        self.client.transaction(store, counter_key)
+
+    def delete(self, *keys):
+        if keys: self.client.delete(*[self.prefix + key for key in keys])
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+
+class LocalClient:
+    """In-process stand-in for a redis client, for development and tests."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, None if ex is None else time.monotonic() + ex)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (0, None))
+            self._data[key] = (str(int(value) + 1).encode(), expires_at)
+            return int(value) + 1
+
+    def transaction(self, func, *watches):
+        # the lock stands in for WATCH, the client itself for the pipeline
+        with self._lock:
+            func(self)
+
+    def multi(self):
+        pass
+
+
+class ReadCache:
+    """Result cache for GET routes, invalidated when writes commit.
+
+    Entities are stored under ``<table>:<id>`` and lists under a key that
+    embeds a per-table generation, so a write drops the entity and every
+    cached list of its table at once. Lookups and invalidations are counted
+    in ``cache_events_total``.
+    """
+
+    def __init__(self, backend, name='read'):
+        self.backend = backend
+        self.name = name
+
+    def generation(self, table):
+        return self.backend.counter(f'{table}:generation')
+
+    def entity_key(self, table, id):
+        return f'{table}:{id}'
+
+    def list_key(self, table, query):
+        return f'{table}:list:{self.generation(table)}:{query}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        self._count('miss' if value is None else 'hit')
+        return value
+
+    def set(self, table, key, value, generation):
+        # skip the write if the table changed while the value was loaded, checked atomically with the write
+        self.backend.set_if(key, value, f'{table}:generation', generation)
+
+    def invalidate(self, changes):
+        # the generation moves first, so a load that read the old one can no longer store an entity once it is deleted
+        tables = {table for table, _, _ in changes}
+        for table in tables:
+            self.backend.incr(f'{table}:generation')
+            self._count('invalidation')
+        for table, _, ids in changes:
+            self.backend.delete(*[self.entity_key(table, id) for id in ids])
+
+    def _count(self, event):
+        registry.inc('cache_events_total', (('cache', self.name), ('event', event)))
+
+
+def create_backend(url=READ_CACHE_URL, maxsize=READ_CACHE_SIZE, ttl=READ_CACHE_TTL, prefix='casting:'):
+    if url is None: return MemoryBackend(maxsize, ttl)
+    import redis
+    return SharedBackend(redis.Redis.from_url(url), ttl, prefix)
+
+
+read_cache = ReadCache(create_backend())
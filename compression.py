@@ -0,0 +1,123 @@
+"""Response compression negotiated from ``Accept-Encoding``.
+
+Bodies of the compressible types are gzipped, or compressed with brotli
+when the ``brotli`` package is installed and the client prefers it. Bodies
+under ``COMPRESS_MIN_SIZE`` go out as they are, since the headers cost more
+than the bytes saved. Streamed exports are compressed chunk by chunk.
+Compressed bodies of responses with an ETag, the ones the read cache keeps,
+are cached too, so a cached list or entity is compressed once per encoding.
+A compressed body is a representation of its own, so its ETag gets the
+encoding as a suffix, which is dropped again to match preconditions.
+"""
+import os
+import zlib
+import hashlib
+from werkzeug.datastructures import ETags
+from werkzeug.http import parse_accept_header
+from cache import READ_CACHE_SIZE, READ_CACHE_TTL, create_backend
+from metrics import phase
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+# compressed bodies kept per process, 0 disables the cache
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', READ_CACHE_SIZE))
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'}
+# in order of preference when the client accepts several equally
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+compressed_cache = create_backend(url=None, maxsize=COMPRESS_CACHE_SIZE, ttl=READ_CACHE_TTL)
+
+
+def choose_encoding(accept_encoding):
+    """The best encoding the client accepts, None for identity."""
+    if not accept_encoding: return None
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+
+def compressor(encoding, level=None):
+    """An object with ``compress(bytes)`` and ``flush()`` for ``encoding``."""
+    if encoding == 'br':
+        return BrotliCompressor(BROTLI_QUALITY if level is None else level)
+    # wbits 31 writes the gzip header and trailer
+    return zlib.compressobj(COMPRESS_LEVEL if level is None else level, zlib.DEFLATED, 31)
+
+
+class BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def compress(body, encoding, level=None):
+    with phase('compress'):
+        stream = compressor(encoding, level)
+        return stream.compress(body) + stream.flush()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress an iterable of str or bytes chunks, yielding bytes as the compressor fills."""
+    stream = compressor(encoding)
+    for chunk in chunks:
+        data = stream.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data: yield data
+    yield stream.flush()
+
+
+async def compress_async_chunks(chunks, encoding):
+    stream = compressor(encoding)
+    async for chunk in chunks:
+        data = stream.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data: yield data
+    yield stream.flush()
+
+
+def compressible(status, headers):
+    """Whether the response may be compressed, in which case it varies by Accept-Encoding."""
+    mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+    return 200 <= status < 300 and status != 204 and mimetype in COMPRESSIBLE and 'Content-Encoding' not in headers
+
+
+def compress_body(body, encoding, cached=False):
+    """The compressed body; with ``cached`` from the cache when the same body was compressed before."""
+    if not cached: return compress(body, encoding)
+    # keyed by the body itself, so a reused ETag can never serve another body
+    key = f'{encoding}:{hashlib.blake2b(body, digest_size=16).hexdigest()}'
+    compressed = compressed_cache.get(key)
+    if compressed is None:
+        compressed = compress(body, encoding)
+        compressed_cache.set(key, compressed)
+    return compressed
+
+
+def encoded_etag(etag, encoding):
+    return f'{etag}-{encoding}'
+
+
+def plain_etags(etags):
+    """If-None-Match or If-Match ``etags`` with the suffixes of ``encoded_etag`` removed."""
+    if not etags or etags.star_tag: return etags
+
+    def plain(tag):
+        for encoding in ('br', 'gzip'):
+            if tag.endswith(f'-{encoding}'): return tag[:-len(encoding) - 1]
+        return tag
+
+    strong = etags.as_set()
+    return ETags({plain(tag) for tag in strong}, {plain(tag) for tag in etags.as_set(include_weak=True) - strong})
+
+
+def add_vary(headers):
+    vary = [value.strip() for value in headers.get('Vary', '').split(',') if value.strip()]
+    if 'accept-encoding' not in (value.lower() for value in vary):
+        headers['Vary'] = ', '.join(vary + ['Accept-Encoding'])
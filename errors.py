@@ -1,5 +1,11 @@
 errors = {
     400: 'bad request',
     401: 'unauthorized',
-    404: 'not found'
+    404: 'not found',
+    405: 'method not allowed',
+    410: 'gone',
+    412: 'precondition failed',
+    413: 'payload too large',
+    429: 'too many requests',
+    503: 'service unavailable'
 }
\ No newline at end of file
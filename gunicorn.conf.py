@@ -0,0 +1,28 @@
+"""gunicorn hooks, loaded automatically from the working directory.
+
+Workers drop database connections inherited from a ``--preload`` master and,
+with ``WARMUP=true``, fetch the signing keys and fill the connection pool
+before they accept requests. With ``METRICS_DIR`` a worker writes its metrics
+when it exits and the master folds them into the totals of exited workers.
+"""
+import time
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    from app import init_worker
+    init_worker(worker.wsgi)
+    worker.log.info('Worker %s ready in %.1f ms', worker.pid, (time.perf_counter() - worker.forked_at) * 1000)
+
+
+def worker_exit(server, worker):
+    from metrics import registry
+    registry.flush(force=True)
+
+
+def child_exit(server, worker):
+    from metrics import registry
+    registry.retire(worker.pid)
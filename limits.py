@@ -0,0 +1,157 @@
+"""Per-subject rate limits and load shedding of the authenticated routes.
+
+Each JWT subject gets a token bucket per permission: ``rate`` requests per
+second with bursts of up to ``burst``, set per role in ``RATE_LIMITS``. A
+client over its limit gets 429 with Retry-After instead of a worker and a
+database connection. The buckets live in the process unless
+``RATE_LIMIT_URL`` points to a redis shared by all workers.
+
+Admission control answers 503 before the token is verified while the
+process already serves ``MAX_IN_FLIGHT`` requests or ``MAX_POOL_WAITING``
+requests wait for a database connection.
+"""
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from cache import READ_CACHE_URL
+from models import TimedPoolMixin
+
+# role=rate/burst pairs, requests per second of a subject on one permission; empty disables the limits
+RATE_LIMITS = os.environ.get('RATE_LIMITS', 'assistant=20/40,director=20/40,producer=50/100')
+# redis:// URL of buckets shared by all workers, the default is per process
+RATE_LIMIT_URL = os.environ.get('RATE_LIMIT_URL', READ_CACHE_URL)
+# buckets kept per process, the least recently used are dropped
+RATE_LIMIT_SIZE = int(os.environ.get('RATE_LIMIT_SIZE', 10000))
+# requests served at once by a process before new ones get 503, 0 disables the check
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 0))
+# requests waiting for a database connection before new ones get 503, 0 disables the check
+MAX_POOL_WAITING = int(os.environ.get('MAX_POOL_WAITING', 0))
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 1))
+
+# the permission that tells each role apart, most privileged first
+ROLES = (('producer', 'delete:movies'), ('director', 'patch:actors'), ('assistant', 'get:actors'))
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code, description, retry_after):
+        self.status_code = status_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+def parse_limits(spec):
+    """``assistant=20/40,...`` to ``{'assistant': (20.0, 40.0)}``."""
+    limits = {}
+    for item in filter(None, spec.split(',')):
+        role, _, limit = item.partition('=')
+        rate, _, burst = limit.partition('/')
+        limits[role.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+def role(payload):
+    permissions = payload.get('permissions', ())
+    for name, permission in ROLES:
+        if permission in permissions: return name
+    return ROLES[-1][0]
+
+
+class MemoryBuckets:
+    """Token buckets of this process."""
+
+    def __init__(self, maxsize=RATE_LIMIT_SIZE):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token; 0 if there was one, otherwise the seconds until there is."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1: tokens -= 1
+            else: wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# the same refill and take as MemoryBuckets, atomic in redis
+TAKE_SCRIPT = '''
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+tokens = math.min(burst, tokens + math.max(0, now - (tonumber(bucket[2]) or now)) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class SharedBuckets:
+    """Token buckets in a redis shared by all workers."""
+
+    def __init__(self, client, prefix='casting:bucket:'):
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst, time.time()]))
+
+
+def create_buckets(url=RATE_LIMIT_URL):
+    if url is None: return MemoryBuckets()
+    import redis
+    return SharedBuckets(redis.Redis.from_url(url))
+
+
+class RateLimiter:
+    """429 for a subject that used up the bucket of a permission."""
+
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = limits
+
+    def check(self, permission, payload):
+        limit = self.limits.get(role(payload))
+        if limit is None: return
+        wait = self.buckets.take(f'{payload.get("sub")}:{permission}', *limit)
+        if wait: raise Overloaded(429, 'rate limit exceeded', math.ceil(wait))
+
+
+class Admission:
+    """503 for new requests while this process is saturated."""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_pool_waiting=MAX_POOL_WAITING,
+                 retry_after=SHED_RETRY_AFTER, pool_waiting=TimedPoolMixin.waiting):
+        self.max_in_flight = max_in_flight
+        self.max_pool_waiting = max_pool_waiting
+        self.retry_after = retry_after
+        self.pool_waiting = pool_waiting
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        with self._lock:
+            if (self.max_in_flight and self.in_flight >= self.max_in_flight
+                    or self.max_pool_waiting and self.pool_waiting() >= self.max_pool_waiting):
+                raise Overloaded(503, 'server overloaded', self.retry_after)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+limiter = RateLimiter(create_buckets(), parse_limits(RATE_LIMITS))
+admission = Admission()
@@ -1,14 +1,44 @@
-from flask_script import Manager
+from flask_script import Command, Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, Actor, Change, Movie, Stat
 
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, render_as_batch=True)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+# commands are Command subclasses: @manager.command introspects with inspect.getargspec, gone in Python 3.11
+class CreateDb(Command):
+    """Create missing tables without migrations, for tests and throwaway databases.
+
+    Only the primary is touched, replicas get the tables through replication.
+    """
+
+    def run(self):
+        db.create_all(bind=None)
+
+
+class RebuildStats(Command):
+    """Recount the GET /stats summaries from the actors and movies tables."""
+
+    def run(self):
+        Stat.rebuild((Actor, Movie))
+
+
+class PruneChanges(Command):
+    """Drop the changes older than CHANGES_RETENTION_SECONDS or beyond the newest CHANGES_MAX_ROWS."""
+
+    def run(self):
+        print(f'{Change.prune()} changes pruned')
+
+
+manager.add_command('create_db', CreateDb())
+manager.add_command('rebuild_stats', RebuildStats())
+manager.add_command('prune_changes', PruneChanges())
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
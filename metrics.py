@@ -0,0 +1,223 @@
+"""Request metrics in the Prometheus text format.
+
+Every request is counted per route, method and status. Its latency goes
+into a histogram, and so does the time spent in each phase: token
+verification, database queries (timed through engine events, with the
+number of queries), JSON serialization and compression. A phase is timed by wrapping it
+in ``phase(name)`` while a request is being measured.
+
+Counters live in the process. With ``METRICS_DIR`` set each worker also
+writes a snapshot there at most every ``METRICS_FLUSH_INTERVAL`` seconds.
+``/metrics`` then sums the snapshots of all workers, so counters add up
+across gunicorn workers. When a worker exits the master folds its snapshot
+into ``exited.json``, which keeps its counts, and removes it, so a new
+worker with the same pid starts from zero. The directory is not cleaned
+up when the server stops and has to be emptied before it starts again.
+"""
+import os
+import json
+import time
+import glob
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_DIR = os.environ.get('METRICS_DIR', None)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+PHASES = ('auth', 'db', 'serialize', 'compress')
+# route label of requests that matched no route, so unknown URLs cannot grow the label set
+UNMATCHED = 'unmatched'
+
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by route, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Request latency by route and method.'),
+    'http_request_phase_seconds': ('histogram', 'Time per request spent in auth, db, serialize and compress by route and method.'),
+    'db_queries_per_request': ('histogram', 'Database queries per request by route and method.'),
+    'singleflight_calls_total': ('counter', 'Coalesced calls by name and outcome: leader, coalesced or timeout.'),
+    'cache_events_total': ('counter', 'Cache hits, misses, evictions, invalidations and refreshes by cache and event.')
+}
+
+
+class RequestTimer:
+    """Phase times and query count of the request being served."""
+    __slots__ = ('started', 'phases', 'queries')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+
+current = ContextVar('request_timer', default=None)
+
+
+class Registry:
+    """Counters and histograms of this process, merged with other workers on collect."""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flushed_at = 0
+        # (name, labels) -> value for counters, -> [bucket counts, sum, count] for histograms
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = [[0] * len(buckets), 0.0, 0, buckets]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(counts), total, count, buckets]
+                               for (name, labels), (counts, total, count, buckets) in self.histograms.items()]
+            }
+
+    def flush(self, force=False):
+        """Write this worker's snapshot to the metrics directory."""
+        now = time.monotonic()
+        if self.directory is None or not force and now - self.flushed_at < self.flush_interval: return
+        self.flushed_at = now
+        write_snapshot(os.path.join(self.directory, f'{os.getpid()}.json'), self.snapshot())
+
+    def retire(self, pid):
+        """Fold the snapshot of the exited worker ``pid`` into ``exited.json``."""
+        if self.directory is None: return
+        path = os.path.join(self.directory, f'{pid}.json')
+        snapshot = read_snapshot(path)
+        if snapshot is None: return
+        exited = os.path.join(self.directory, 'exited.json')
+        counters, histograms = merge([snapshot, read_snapshot(exited) or {'counters': [], 'histograms': []}])
+        write_snapshot(exited, {
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'histograms': [[name, labels, *histogram] for (name, labels), histogram in histograms.items()]
+        })
+        os.remove(path)
+
+    def collect(self):
+        """Sum the snapshots of all workers, or return this process's own."""
+        if self.directory is None: return [self.snapshot()]
+        self.flush(force=True)
+        snapshots = (read_snapshot(path) for path in glob.glob(os.path.join(self.directory, '*.json')))
+        return [snapshot for snapshot in snapshots if snapshot is not None]
+
+    def render(self):
+        counters, histograms = merge(self.collect())
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name: lines.append(f'{name}{format_labels(labels)} {value}')
+            for (metric, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+                if metric != name: continue
+                cumulative = 0
+                for bound, bucket in zip(buckets, counts):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def merge(snapshots):
+    """Sum snapshots into counters and histograms keyed by name and labels."""
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total, count, buckets in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0, buckets])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+    return counters, histograms
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(path, snapshot):
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+registry = Registry()
+
+
+def start_request():
+    """Start measuring a request; pass the result to ``finish_request``."""
+    return current.set(RequestTimer())
+
+
+def finish_request(token, route, method, status):
+    timer = current.get()
+    current.reset(token)
+    if timer is None: return
+    duration = time.perf_counter() - timer.started
+    registry.inc('http_requests_total', (('method', method), ('route', route), ('status', str(status))))
+    registry.observe('http_request_duration_seconds', (('method', method), ('route', route)),
+                     duration, LATENCY_BUCKETS)
+    for name, seconds in timer.phases.items():
+        registry.observe('http_request_phase_seconds', (('method', method), ('phase', name), ('route', route)),
+                         seconds, LATENCY_BUCKETS)
+    registry.observe('db_queries_per_request', (('method', method), ('route', route)), timer.queries, QUERY_BUCKETS)
+    registry.flush()
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to a phase of the current request."""
+    timer = current.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.phases[name] += time.perf_counter() - started
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None: context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    timer = current.get()
+    if timer is None or context is None: return
+    timer.phases['db'] += time.perf_counter() - context._metrics_started
+    timer.queries += 1
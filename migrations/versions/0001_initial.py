@@ -0,0 +1,42 @@
+"""initial schema
+
+Revision ID: 0001_initial
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_initial'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases created before migrations were added already have the tables
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'movies' not in tables:
+        op.create_table('movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=False),
+            sa.Column('release_date', sa.String(length=50), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('title')
+        )
+    if 'actors' not in tables:
+        op.create_table('actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=50), nullable=False),
+            sa.Column('age', sa.Integer(), nullable=False),
+            sa.Column('gender', sa.String(length=10), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('actors')
+    op.drop_table('movies')
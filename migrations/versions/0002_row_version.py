@@ -0,0 +1,40 @@
+"""row version and updated_at for conditional requests
+
+Revision ID: 0002_row_version
+Revises: 0001_initial
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_row_version'
+down_revision = '0001_initial'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in ('movies', 'actors'):
+        # db.create_all() may have created the columns already
+        if 'version' in {column['name'] for column in inspector.get_columns(table)}:
+            continue
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute(sa.table(table, sa.column('updated_at')).update().values(updated_at=sa.func.now()))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', existing_type=sa.DateTime(), nullable=False,
+                                  server_default=sa.func.now())
+            batch_op.create_index(f'ix_{table}_updated_at', ['updated_at'])
+
+
+def downgrade():
+    for table in ('movies', 'actors'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_index(f'ix_{table}_updated_at')
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')
@@ -0,0 +1,34 @@
+"""indexes for list filters and sorting
+
+Revision ID: 0003_list_indexes
+Revises: 0002_row_version
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_list_indexes'
+down_revision = '0002_row_version'
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_actors_gender_age', 'actors', ['gender', 'age']),
+    ('ix_movies_release_date', 'movies', ['release_date']),
+)
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns in INDEXES:
+        # db.create_all() may have created the index already
+        if name not in {index['name'] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in INDEXES:
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,62 @@
+"""store movies.release_date as an indexed DATE
+
+Revision ID: 0004_release_date_type
+Revises: 0003_list_indexes
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from dateutil import parser
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_release_date_type'
+down_revision = '0003_list_indexes'
+branch_labels = None
+depends_on = None
+
+movies = sa.table('movies',
+    sa.column('id', sa.Integer),
+    sa.column('release_date', sa.String),
+    sa.column('release_day', sa.Date)
+)
+
+
+def upgrade():
+    columns = sa.inspect(op.get_bind()).get_columns('movies')
+    # db.create_all() may have created the column as DATE already
+    if any(column['name'] == 'release_date' and isinstance(column['type'], sa.Date) for column in columns):
+        return
+
+    op.add_column('movies', sa.Column('release_day', sa.Date(), nullable=True))
+
+    connection = op.get_bind()
+    days, invalid = [], []
+    for id, release_date in connection.execute(sa.select(movies.c.id, movies.c.release_date)).fetchall():
+        try:
+            days.append({'_id': id, 'release_day': parser.parse(release_date).date()})
+        except (ValueError, OverflowError):
+            invalid.append(id)
+    if invalid:
+        raise RuntimeError(f'unparseable movies.release_date for ids {invalid}, fix them and rerun')
+    if days:
+        connection.execute(movies.update().where(movies.c.id == sa.bindparam('_id')), days)
+
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_index('ix_movies_release_date')
+        batch_op.drop_column('release_date')
+        batch_op.alter_column('release_day', new_column_name='release_date',
+                              existing_type=sa.Date(), nullable=False)
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+
+
+def downgrade():
+    op.add_column('movies', sa.Column('release_day', sa.String(length=50), nullable=True))
+    op.execute(movies.update().values(release_day=sa.cast(movies.c.release_date, sa.String(50))))
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_index('ix_movies_release_date')
+        batch_op.drop_column('release_date')
+        batch_op.alter_column('release_day', new_column_name='release_date',
+                              existing_type=sa.String(length=50), nullable=False)
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
@@ -0,0 +1,52 @@
+"""full-text search indexes on actors.name and movies.title
+
+Revision ID: 0005_search_indexes
+Revises: 0004_release_date_type
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_search_indexes'
+down_revision = '0004_release_date_type'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (('actors', 'name'), ('movies', 'title'))
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in COLUMNS:
+        fts = f'{table}_fts'
+        if dialect == 'sqlite':
+            op.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='id')")
+            op.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+                       f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END")
+            op.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+                       f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END")
+            op.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+                       f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+                       f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END")
+            op.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        elif dialect == 'postgresql':
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            op.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_tsv ON {table} "
+                       f"USING gin (to_tsvector('simple'::regconfig, {column}))")
+            op.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in COLUMNS:
+        fts = f'{table}_fts'
+        if dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER IF EXISTS {fts}_{trigger}')
+            op.execute(f'DROP TABLE IF EXISTS {fts}')
+        elif dialect == 'postgresql':
+            op.execute(f'DROP INDEX IF EXISTS ix_{table}_{column}_trgm')
+            op.execute(f'DROP INDEX IF EXISTS ix_{table}_{column}_tsv')
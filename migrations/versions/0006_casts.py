@@ -0,0 +1,31 @@
+"""casts table linking actors to the movies they play in
+
+Revision ID: 0006_casts
+Revises: 0005_search_indexes
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006_casts'
+down_revision = '0005_search_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'casts',
+        sa.Column('movie_id', sa.Integer(), sa.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('actor_id', sa.Integer(), sa.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('role', sa.String(), nullable=False)
+    )
+    op.create_index('ix_casts_actor_id', 'casts', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_casts_actor_id', table_name='casts')
+    op.drop_table('casts')
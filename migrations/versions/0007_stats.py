@@ -0,0 +1,45 @@
+"""stats table with per-group row counts of actors and movies
+
+Revision ID: 0007_stats
+Revises: 0006_casts
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007_stats'
+down_revision = '0006_casts'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    stats = op.create_table(
+        'stats',
+        sa.Column('table_name', sa.String(), primary_key=True),
+        sa.Column('dimension', sa.String(), primary_key=True),
+        sa.Column('bucket', sa.String(), primary_key=True),
+        sa.Column('count', sa.Integer(), nullable=False)
+    )
+    actors = sa.table('actors', sa.column('gender', sa.String()), sa.column('age', sa.Integer()))
+    movies = sa.table('movies', sa.column('release_date', sa.Date()))
+    # the groups of Actor.dimensions and Movie.dimensions at this revision
+    groups = (
+        ('actors', 'gender', actors.c.gender),
+        ('actors', 'age', actors.c.age - actors.c.age % 10),
+        ('movies', 'release_year', sa.cast(sa.extract('year', movies.c.release_date), sa.Integer))
+    )
+    for table, dimension, expression in groups:
+        bucket = sa.cast(expression, sa.String)
+        op.execute(stats.insert().from_select(
+            ['table_name', 'dimension', 'bucket', 'count'],
+            sa.select(sa.literal_column(f"'{table}'"), sa.literal_column(f"'{dimension}'"), bucket, sa.func.count())
+            .group_by(bucket)
+        ))
+
+
+def downgrade():
+    op.drop_table('stats')
@@ -0,0 +1,36 @@
+"""append-only change log read by the change feeds
+
+Revision ID: 0008_changes
+Revises: 0007_stats
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008_changes'
+down_revision = '0007_stats'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'changes',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('op', sa.String(), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sqlite_autoincrement=True
+    )
+    op.create_index('ix_changes_created_at', 'changes', ['created_at'])
+    op.create_index('ix_changes_table_name_id', 'changes', ['table_name', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_changes_table_name_id', table_name='changes')
+    op.drop_index('ix_changes_created_at', table_name='changes')
+    op.drop_table('changes')
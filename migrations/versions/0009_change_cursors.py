@@ -0,0 +1,38 @@
+"""order changes by transaction and keep the pruned watermark
+
+Revision ID: 0009_change_cursors
+Revises: 0008_changes
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009_change_cursors'
+down_revision = '0008_changes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a rebuilt SQLite table must keep AUTOINCREMENT, so ids are never reused
+    with op.batch_alter_table('changes', table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+        batch_op.add_column(sa.Column('txid', sa.BigInteger(), nullable=False, server_default='0'))
+    op.drop_index('ix_changes_table_name_id', table_name='changes')
+    op.create_index('ix_changes_table_name_txid_id', 'changes', ['table_name', 'txid', 'id'])
+    op.create_table(
+        'change_watermark',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('txid', sa.BigInteger(), nullable=False),
+        sa.Column('change_id', sa.Integer(), nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_table('change_watermark')
+    op.drop_index('ix_changes_table_name_txid_id', table_name='changes')
+    op.create_index('ix_changes_table_name_id', 'changes', ['table_name', 'id'])
+    with op.batch_alter_table('changes', table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+        batch_op.drop_column('txid')
@@ -1,30 +1,747 @@
 import os
-from sqlalchemy import Column, Integer, String
-from flask_sqlalchemy import SQLAlchemy
+import time
+import itertools
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    BigInteger, Column, Date, DateTime, ForeignKey, Index, Integer, String, bindparam, cast, delete, event, extract,
+    false, func, insert, inspect, literal_column, select, true, tuple_, union_all, update
+)
+from sqlalchemy import exc
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, relationship, sessionmaker
+from sqlalchemy.sql import visitors
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
 
-database_path = os.environ.get('DATABASE_URL', 'sqlite:///database.sqlite')
 
-if database_path.startswith('postgres://'):
-    database_path = f'{database_path[:7]}sql{database_path[8:]}'
+def normalize_url(url):
+    # Heroku still hands out the postgres:// scheme that SQLAlchemy 1.4 dropped
+    if url.startswith('postgres://'): return f'{url[:7]}sql{url[8:]}'
+    return url
 
-db = SQLAlchemy()
 
-def setup_db(app=None, database_path=database_path):
+database_path = normalize_url(os.environ.get('DATABASE_URL', 'sqlite:///database.sqlite'))
+# comma separated URLs of read replicas of DATABASE_URL
+replica_paths = [normalize_url(url) for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+
+# connection pool of each process, SQLite keeps Flask-SQLAlchemy's NullPool
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds after which a connection is replaced, -1 keeps connections forever
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# test each connection on checkout so connections dropped by a failover are replaced
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# seconds a replica that failed to connect is skipped before it is tried again
+DB_REPLICA_RETRY_SECONDS = float(os.environ.get('DB_REPLICA_RETRY_SECONDS', 30))
+# seconds a client's reads stay on the primary after it wrote, to cover the replication lag
+DB_REPLICA_PIN_SECONDS = int(os.environ.get('DB_REPLICA_PIN_SECONDS', 5))
+# the change log keeps this many seconds of changes, and at most this many, see Change.prune
+CHANGES_RETENTION_SECONDS = int(os.environ.get('CHANGES_RETENTION_SECONDS', 7 * 24 * 3600))
+CHANGES_MAX_ROWS = int(os.environ.get('CHANGES_MAX_ROWS', 1000000))
+
+
+class ReplicaSet:
+    """Round-robin over the replica binds, skipping replicas that failed to connect."""
+
+    def __init__(self, keys, retry=DB_REPLICA_RETRY_SECONDS):
+        self.keys = list(keys)
+        self.retry = retry
+        self._next = itertools.count()
+        self._down_until = {}
+        self._stats = {key: {'reads': 0, 'failures': 0} for key in self.keys}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def pick(self, get_engine):
+        """The engine of the next healthy replica, None when all are down.
+
+        A connection is checked out once per pick, so an unreachable replica
+        is noticed before the request uses it.
+        """
+        for _ in self.keys:
+            key = self.keys[next(self._next) % len(self.keys)]
+            if self._down_until.get(key, 0) > time.monotonic(): continue
+            engine = get_engine(key)
+            try:
+                engine.connect().close()
+            except exc.DBAPIError:
+                with self._lock:
+                    self._down_until[key] = time.monotonic() + self.retry
+                    self._stats[key]['failures'] += 1
+                continue
+            with self._lock:
+                self._stats[key]['reads'] += 1
+            return engine
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {key: dict(stats, up=self._down_until.get(key, 0) <= now) for key, stats in self._stats.items()}
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from a replica while ``info['read_only']`` is set.
+
+    Flushes and INSERT, UPDATE and DELETE statements go to the primary and
+    pin the rest of the session there, so a request reads its own writes.
+    Without a healthy replica everything goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, *args, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False): self.info['pinned'] = True
+        replicas = self.app.extensions.get('replicas')
+        if replicas and self.info.get('read_only') and not self.info.get('pinned'):
+            if 'replica' not in self.info:
+                self.info['replica'] = replicas.pick(lambda key: db.get_engine(self.app, bind=key))
+            if self.info['replica'] is not None: return self.info['replica']
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# called with the list of (table, op, ids) changes after each commit
+commit_listeners = []
+
+
+class TimedPoolMixin:
+    """Count checkouts and the time callers wait for a connection.
+
+    The time includes waiting for a free connection, opening a new one and
+    the pre-ping. The counters carry over when the engine recreates the pool.
+    """
+    # callers inside connect() across the pools of the process
+    _waiting = 0
+    _waiting_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats = {'checkouts': 0, 'timeouts': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def waiting(cls):
+        return cls._waiting
+
+    def connect(self):
+        started = time.perf_counter()
+        timed_out = False
+        with TimedPoolMixin._waiting_lock:
+            TimedPoolMixin._waiting += 1
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with TimedPoolMixin._waiting_lock:
+                TimedPoolMixin._waiting -= 1
+            with self._stats_lock:
+                self._stats['checkouts'] += 1
+                self._stats['timeouts'] += timed_out
+                self._stats['wait_seconds_total'] += waited
+                self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool._stats = self._stats
+        pool._stats_lock = self._stats_lock
+        return pool
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(url, poolclass=TimedQueuePool):
+    """Pool settings from the DB_POOL_* variables, none for SQLite."""
+    if url.startswith('sqlite'): return {}
+    return {
+        'poolclass': poolclass,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+def pool_stats(pool):
+    """Connection counts and checkout wait time of this process's pool."""
+    stats = {'pid': os.getpid(), 'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'timeout': pool.timeout()
+        })
+    if isinstance(pool, TimedPoolMixin): stats.update(pool.stats())
+    return stats
+
+
+def setup_db(app=None, database_path=database_path, replica_paths=replica_paths):
+    binds = {f'replica{i}': url for i, url in enumerate(replica_paths)}
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
+    app.config['SQLALCHEMY_BINDS'] = binds
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    app.extensions['replicas'] = ReplicaSet(binds)
     return db
 
-class Movie(db.Model):
+
+# SQLite only honours ON DELETE CASCADE when foreign keys are enabled per connection
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if 'sqlite' in type(dbapi_connection).__module__:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def record_changes(table, op, ids, session=None):
+    """Log written rows in the change log and remember them until the commit."""
+    session = session or db.session()
+    session.info.setdefault('changes', []).append((table, op, tuple(ids)))
+    Change.log(session.connection(), table, op, ids)
+
+
+# registered on Session so sessions of the asyncio engine are covered too
+@event.listens_for(Session, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    for op, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            # association rows such as casts have no id of their own
+            if not hasattr(obj, 'id'): continue
+            if op != 'update' or session.is_modified(obj):
+                record_changes(obj.__tablename__, op, [obj.id], session)
+
+
+def stats_changes(session):
+    """Ids per model of the dirty and deleted rows whose stats groups may change."""
+    ids = {}
+    for obj in session.dirty:
+        if not hasattr(obj, 'dimensions'): continue
+        state = inspect(obj)
+        if any(state.attrs[column.key].history.has_changes() for column in obj.dimension_columns()):
+            ids.setdefault(type(obj), set()).add(obj.id)
+    for obj in session.deleted:
+        if hasattr(obj, 'dimensions'): ids.setdefault(type(obj), set()).add(obj.id)
+    return ids
+
+
+@event.listens_for(Session, 'before_flush')
+def count_stats_before_flush(session, flush_context, instances):
+    changed = stats_changes(session)
+    if changed:
+        connection = session.connection()
+        for model, ids in changed.items():
+            Stat.lock(model, connection, ids)
+        session.info['stats'] = {model: (ids, Stat.group_counts(model, connection, ids))
+                                 for model, ids in changed.items()}
+
+
+@event.listens_for(Session, 'after_flush')
+def update_stats_after_flush(session, flush_context):
+    before = session.info.pop('stats', {})
+    ids = {model: set(model_ids) for model, (model_ids, _) in before.items()}
+    for obj in session.new:
+        if hasattr(obj, 'dimensions'): ids.setdefault(type(obj), set()).add(obj.id)
+    if not ids: return
+    connection = session.connection()
+    for model, model_ids in ids.items():
+        delta = Stat.group_counts(model, connection, model_ids)
+        if model in before: delta.subtract(before[model][1])
+        Stat.apply(model, connection, delta)
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_commit_listeners(session):
+    changes = session.info.pop('changes', None)
+    if changes:
+        for listener in commit_listeners:
+            listener(changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_changes(session, previous_transaction):
+    session.info.pop('changes', None)
+
+
+class Stat(db.Model):
+    """Row count of one group of a table, e.g. actors with gender female.
+
+    Every write applies its change to the counts in its own transaction, so
+    reading the statistics of a table costs one row per group. The groups
+    are the SQL expressions in the ``dimensions`` of the model.
+    """
+    __tablename__ = 'stats'
+    table_name = Column(String(), primary_key=True)
+    dimension = Column(String(), primary_key=True)
+    bucket = Column(String(), primary_key=True)
+    count = Column(Integer, nullable=False)
+
+    @staticmethod
+    def lock(model, connection, ids):
+        """Lock the rows ``ids`` until commit, before their old counts are read.
+
+        Otherwise a concurrent write could change a row between the read and
+        our write, and both writes would subtract the same old group. SQLite
+        has no row locks, a write that matches no row takes its database lock.
+        """
+        table = model.__table__
+        if connection.dialect.name == 'sqlite':
+            connection.execute(update(table).where(false()).values(id=table.c.id))
+        else:
+            connection.execute(select(table.c.id).where(table.c.id.in_(ids)).with_for_update())
+
+    @staticmethod
+    def group_counts(model, connection, ids=None):
+        """Rows per (dimension, bucket) among ``ids``, or in the whole table, in one query."""
+        selects = []
+        for dimension, expression in model.dimensions.items():
+            bucket = cast(expression, String)
+            stmt = select(literal_column(f"'{dimension}'"), bucket, func.count()).group_by(bucket)
+            if ids is not None: stmt = stmt.where(model.id.in_(ids))
+            selects.append(stmt)
+        rows = connection.execute(union_all(*selects))
+        return Counter({(dimension, bucket): count for dimension, bucket, count in rows})
+
+    @classmethod
+    def apply(cls, model, connection, delta):
+        """Add a Counter of (dimension, bucket) changes to the stored counts."""
+        rows = [{'table_name': model.__tablename__, 'dimension': dimension, 'bucket': bucket, 'count': count}
+                for (dimension, bucket), count in delta.items() if count]
+        if not rows: return
+        dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+        stmt = dialect.insert(cls.__table__)
+        stmt = stmt.on_conflict_do_update(index_elements=['table_name', 'dimension', 'bucket'],
+                                          set_={'count': cls.__table__.c.count + stmt.excluded['count']})
+        connection.execute(stmt, rows)
+
+    @classmethod
+    def summary(cls, model, session=None):
+        """{dimension: {bucket: count}} of a table, read from the stored counts."""
+        session = session or db.session
+        table = cls.__table__
+        stmt = (select(table.c.dimension, table.c.bucket, table.c.count)
+                .where(table.c.table_name == model.__tablename__, table.c.count > 0)
+                .order_by(table.c.dimension, table.c.bucket))
+        summary = {dimension: {} for dimension in model.dimensions}
+        for row in session.execute(stmt):
+            summary[row.dimension][row.bucket] = row.count
+        return summary
+
+    @classmethod
+    def rebuild(cls, models, session=None):
+        """Recount the groups of ``models`` from their tables, for when the counts drifted."""
+        session = session or db.session
+        try:
+            connection = session.connection()
+            for model in models:
+                connection.execute(delete(cls.__table__).where(cls.__table__.c.table_name == model.__tablename__))
+                cls.apply(model, connection, cls.group_counts(model, connection))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+
+def format_cursor(txid, id):
+    return f'{txid}-{id}'
+
+
+def parse_cursor(cursor):
+    """The ``(txid, id)`` of a change feed cursor, None when it is malformed."""
+    txid, _, id = cursor.partition('-')
+    if not (txid.isdigit() and id.isdigit()): return None
+    return int(txid), int(id)
+
+
+class Change(db.Model):
+    """One written row in the append-only log read by the change feeds.
+
+    Each write logs its rows in its own transaction, so the log never
+    disagrees with the tables. Writers do not wait for each other: the
+    cursor of a change is the id of the transaction that logged it and its
+    own id, and on Postgres readers stop before the oldest transaction still
+    in flight (``txid_snapshot_xmin``), so no change can commit behind a
+    cursor they handed out. SQLite serializes writers, its txid is always 0.
+    """
+    __tablename__ = 'changes'
+    id = Column(Integer, primary_key=True)
+    txid = Column(BigInteger, nullable=False, default=0)
+    table_name = Column(String(), nullable=False)
+    op = Column(String(), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+    # ids of pruned changes are never reused, so an old cursor cannot point past a newer change
+    __table_args__ = (Index('ix_changes_table_name_txid_id', 'table_name', 'txid', 'id'),
+                      {'sqlite_autoincrement': True})
+
+    @classmethod
+    def log(cls, connection, table, op, ids):
+        if not ids: return
+        stmt = insert(cls.__table__)
+        if connection.dialect.name == 'postgresql': stmt = stmt.values(txid=func.txid_current())
+        now = datetime.utcnow()
+        connection.execute(stmt, [{'table_name': table, 'op': op, 'row_id': id, 'created_at': now} for id in ids])
+
+    @classmethod
+    def _settled(cls, session):
+        """The changes no transaction in flight can commit before."""
+        table = cls.__table__
+        if session.get_bind().dialect.name != 'postgresql': return true()
+        return table.c.txid < func.txid_snapshot_xmin(func.txid_current_snapshot())
+
+    @classmethod
+    def _last(cls, session, *criteria, offset=0):
+        table = cls.__table__
+        row = session.execute(select(table.c.txid, table.c.id).where(cls._settled(session), *criteria)
+                              .order_by(table.c.txid.desc(), table.c.id.desc()).offset(offset).limit(1)).first()
+        return None if row is None else tuple(row)
+
+    @classmethod
+    def head(cls, session=None):
+        """The cursor of the newest change, of the last pruned one when the log is empty."""
+        session = session or db.session
+        return format_cursor(*(cls._last(session) or ChangeWatermark.get(session)))
+
+    @classmethod
+    def feed(cls, model, since, limit, session=None):
+        """Up to ``limit`` changes of ``model`` after the cursor ``since``.
+
+        Returns the changes, the cursor to continue from and whether more
+        changes follow, or None when changes after ``since`` were pruned.
+        The changes of a row in the batch are merged into the newest, which
+        carries the row as it is now, or None once it is deleted.
+        """
+        session = session or db.session
+        table = cls.__table__
+        after = parse_cursor(since)
+        if after < ChangeWatermark.get(session): return None
+        stmt = (select(table.c.id, table.c.txid, table.c.table_name, table.c.op, table.c.row_id)
+                .where(table.c.table_name.in_(model.changes_tables), tuple_(table.c.txid, table.c.id) > after,
+                       cls._settled(session))
+                .order_by(table.c.txid, table.c.id).limit(limit + 1))
+        changes = session.execute(stmt).all()
+        more = len(changes) > limit
+        changes = changes[:limit]
+        if not changes: return [], since, False
+        newest = {(change.table_name, change.row_id): change for change in changes}
+        names = ('id',) + model.fields
+        columns = [model.__table__.c[name] for name in names]
+        ids = {change.row_id for change in newest.values()}
+        rows = {row.id: dict(zip(names, row)) for row in session.execute(select(*columns).where(columns[0].in_(ids)))}
+        return [{'cursor': format_cursor(change.txid, change.id), 'table': change.table_name, 'op': change.op,
+                 'id': change.row_id, 'row': rows.get(change.row_id)}
+                for change in sorted(newest.values(), key=lambda change: (change.txid, change.id))], \
+            format_cursor(changes[-1].txid, changes[-1].id), more
+
+    @classmethod
+    def prune(cls, retention=CHANGES_RETENTION_SECONDS, max_rows=CHANGES_MAX_ROWS, session=None):
+        """Drop the changes older than ``retention`` seconds or beyond the newest ``max_rows``.
+
+        The cursor of the last dropped change becomes the watermark below
+        which feeds answer 410, so a cursor at or after it stays valid even
+        when the log is empty. Returns the number of changes dropped.
+        """
+        session = session or db.session
+        table = cls.__table__
+        try:
+            outdated = [cursor for cursor in (
+                cls._last(session, table.c.created_at < datetime.utcnow() - timedelta(seconds=retention)),
+                cls._last(session, offset=max(max_rows, 0))) if cursor is not None]
+            if not outdated: return 0
+            last = max(outdated)
+            count = session.execute(delete(table).where(cls._settled(session),
+                                                        tuple_(table.c.txid, table.c.id) <= last)).rowcount
+            ChangeWatermark.raise_to(last, session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return count
+
+
+class ChangeWatermark(db.Model):
+    """The cursor of the last pruned change, a single row."""
+    __tablename__ = 'change_watermark'
+    id = Column(Integer, primary_key=True)
+    txid = Column(BigInteger, nullable=False)
+    change_id = Column(Integer, nullable=False)
+
+    @classmethod
+    def get(cls, session):
+        row = session.execute(select(cls.txid, cls.change_id).where(cls.id == 1)).first()
+        return (0, 0) if row is None else tuple(row)
+
+    @classmethod
+    def raise_to(cls, cursor, session):
+        txid, change_id = cursor
+        if cls.get(session) >= cursor: return
+        if session.execute(update(cls.__table__).where(cls.id == 1)
+                           .values(txid=txid, change_id=change_id)).rowcount == 0:
+            session.execute(insert(cls.__table__).values(id=1, txid=txid, change_id=change_id))
+
+
+class BatchMixin:
+    """Bulk and single-row writes that run as a few statements inside a single transaction.
+
+    ``session`` defaults to the Flask-SQLAlchemy session.
+    """
+
+    @classmethod
+    def update_one(cls, id, values, versions=None, session=None):
+        """Update a row with one ``UPDATE ... RETURNING`` and return its new version.
+
+        With ``versions`` only a row still at one of them is updated, so a
+        concurrent edit is detected without locking the row; only a change of
+        a stats dimension locks it. Returns None when the row does not exist
+        and False when its version moved on. Without ``values`` nothing is
+        written and the current version is returned.
+        """
+        session = session or db.session
+        table = cls.__table__
+        if not values:
+            row = session.execute(cls._one(select(table.c.version), id, versions)).first()
+            return cls._missing(id, versions, session) if row is None else row.version
+        stmt = cls._one(update(table), id, versions).values(version=table.c.version + 1, **values)
+        try:
+            connection = session.connection()
+            before = None
+            if any(column.key in values for column in cls.dimension_columns()):
+                Stat.lock(cls, connection, [id])
+                before = Stat.group_counts(cls, connection, [id])
+            columns = [table.c.version] + (cls.buckets() if before is not None else [])
+            if connection.dialect.full_returning:
+                row = session.execute(stmt.returning(*columns)).first()
+            else:
+                row = None
+                if session.execute(stmt).rowcount:
+                    row = session.execute(select(*columns).where(table.c.id == id)).first()
+            if row is None:
+                session.rollback()
+                return cls._missing(id, versions, session)
+            if before is not None:
+                delta = cls.bucket_counts(row)
+                delta.subtract(before)
+                Stat.apply(cls, connection, delta)
+            record_changes(table.name, 'update', [id], session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return row.version
+
+    @classmethod
+    def delete_one(cls, id, versions=None, session=None):
+        """Delete a row with one ``DELETE ... RETURNING``, True or None/False like ``update_one``."""
+        session = session or db.session
+        table = cls.__table__
+        stmt = cls._one(delete(table), id, versions)
+        try:
+            connection = session.connection()
+            if connection.dialect.full_returning:
+                row = session.execute(stmt.returning(*cls.buckets())).first()
+            else:
+                row = session.execute(cls._one(select(*cls.buckets()), id, versions)).first()
+                if row is not None and not session.execute(stmt).rowcount: row = None
+            if row is None:
+                session.rollback()
+                return cls._missing(id, versions, session)
+            delta = Counter()
+            delta.subtract(cls.bucket_counts(row))
+            Stat.apply(cls, connection, delta)
+            record_changes(table.name, 'delete', [id], session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return True
+
+    @classmethod
+    def bulk_add(cls, items, session=None):
+        session = session or db.session
+        table = cls.__table__
+        try:
+            if session.connection().dialect.full_returning:
+                result = session.execute(insert(table).values(items).returning(table.c.id))
+                ids = [row.id for row in result]
+            else:
+                session.bulk_insert_mappings(cls, items, return_defaults=True)
+                ids = [item['id'] for item in items]
+            connection = session.connection()
+            Stat.apply(cls, connection, Stat.group_counts(cls, connection, ids))
+            record_changes(table.name, 'insert', ids, session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def bulk_update(cls, items, session=None):
+        session = session or db.session
+        table = cls.__table__
+        try:
+            found = cls._existing_ids((item['id'] for item in items), session)
+            groups = {}
+            for item in items:
+                keys = tuple(sorted(key for key in item if key != 'id'))
+                if item['id'] in found and keys:
+                    params = {key: item[key] for key in keys}
+                    params['_id'] = item['id']
+                    groups.setdefault(keys, []).append(params)
+            stmt = (update(table)
+                    .where(table.c.id == bindparam('_id'))
+                    .values(version=table.c.version + 1))
+            connection = session.connection()
+            Stat.lock(cls, connection, found)
+            before = Stat.group_counts(cls, connection, found)
+            for params in groups.values():
+                session.execute(stmt, params)
+            delta = Stat.group_counts(cls, connection, found)
+            delta.subtract(before)
+            Stat.apply(cls, connection, delta)
+            record_changes(table.name, 'update', found, session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return found
+
+    @classmethod
+    def bulk_delete(cls, ids, session=None):
+        session = session or db.session
+        table = cls.__table__
+        try:
+            found = cls._existing_ids(ids, session)
+            if found:
+                connection = session.connection()
+                Stat.lock(cls, connection, found)
+                delta = Counter()
+                delta.subtract(Stat.group_counts(cls, connection, found))
+                session.execute(delete(table).where(table.c.id.in_(found)))
+                Stat.apply(cls, connection, delta)
+                record_changes(table.name, 'delete', found, session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return found
+
+    @classmethod
+    def _existing_ids(cls, ids, session):
+        table = cls.__table__
+        stmt = select(table.c.id).where(table.c.id.in_(set(ids)))
+        return {row.id for row in session.execute(stmt)}
+
+    @classmethod
+    def _one(cls, stmt, id, versions):
+        table = cls.__table__
+        stmt = stmt.where(table.c.id == id)
+        if versions is not None: stmt = stmt.where(table.c.version.in_(versions))
+        return stmt
+
+    @classmethod
+    def _missing(cls, id, versions, session):
+        # only a failed precondition costs a second query
+        if versions is None or not cls._existing_ids([id], session): return None
+        return False
+
+    @classmethod
+    def buckets(cls):
+        """The stats bucket of each dimension as labelled columns, as ``Stat.group_counts`` casts them."""
+        return [cast(expression, String).label(dimension) for dimension, expression in cls.dimensions.items()]
+
+    @classmethod
+    def bucket_counts(cls, row):
+        return Counter({(dimension, getattr(row, dimension)): 1 for dimension in cls.dimensions})
+
+    @classmethod
+    def dimension_columns(cls):
+        """The columns the stats groups of the model depend on."""
+        return {element for expression in cls.dimensions.values() for element in visitors.iterate(expression)
+                if isinstance(element, Column)}
+
+
+class Cast(db.Model):
+    """The role an actor plays in a movie."""
+    __tablename__ = 'casts'
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+    actor_id = Column(Integer, ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True, index=True)
+    role = Column(String(), nullable=False)
+
+    movie = relationship('Movie', back_populates='cast')
+    actor = relationship('Actor', back_populates='roles')
+
+
+class Movie(BatchMixin, db.Model):
     __tablename__ = 'movies'
+    fields = ('title', 'release_date')
+    # ?include= name: (relationship to Cast, attribute of Cast that is embedded)
+    includes = {'cast': ('cast', 'actor')}
+    # tables whose changes are in the feed of the model, PUT /movies/<id>/cast logs casts by movie id
+    changes_tables = ('movies', 'casts')
     id = Column(Integer, primary_key=True)
     title = Column(String(), nullable=False, unique=True)
-    release_date = Column(String(50), nullable=False)
+    release_date = Column(Date, nullable=False, index=True)
+    # GET /stats/movies groups, as SQL so every write path counts them the same way
+    dimensions = {'release_year': cast(extract('year', release_date), Integer)}
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    updated_at = Column(DateTime, nullable=False, index=True, default=datetime.utcnow,
+                        onupdate=datetime.utcnow, server_default=func.now())
+
+    cast = relationship('Cast', back_populates='movie', order_by=Cast.actor_id,
+                        cascade='all, delete-orphan', passive_deletes=True)
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
+
+    @classmethod
+    def replace_cast(cls, id, cast, session=None):
+        """Replace the cast of a movie in one transaction; False if the movie does not exist."""
+        session = session or db.session
+        table = Cast.__table__
+        try:
+            found = cls._existing_ids([id], session)
+            if found:
+                session.execute(delete(table).where(table.c.movie_id == id))
+                if cast: session.execute(insert(table), [dict(item, movie_id=id) for item in cast])
+                record_changes(table.name, 'update', found, session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return bool(found)
     
     def add(self):
         db.session.add(self)
@@ -41,16 +758,29 @@ class Movie(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date
+            'release_date': self.release_date.isoformat()
         }
 
 
-class Actor(db.Model):
+class Actor(BatchMixin, db.Model):
     __tablename__ = 'actors'
+    fields = ('name', 'age', 'gender')
+    includes = {'movies': ('roles', 'movie')}
+    changes_tables = ('actors',)
     id = Column(Integer, primary_key=True)
     name = Column(String(50), nullable=False)
     age = Column(Integer, nullable=False)
     gender = Column(String(10), nullable=False)
+    dimensions = {'gender': gender, 'age': age - age % 10}
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    updated_at = Column(DateTime, nullable=False, index=True, default=datetime.utcnow,
+                        onupdate=datetime.utcnow, server_default=func.now())
+
+    roles = relationship('Cast', back_populates='actor', order_by=Cast.movie_id,
+                         cascade='all, delete-orphan', passive_deletes=True)
+
+    __table_args__ = (Index('ix_actors_gender_age', 'gender', 'age'),)
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, name, age, gender):
         self.name = name
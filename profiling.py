@@ -0,0 +1,122 @@
+"""Query profiling: the Server-Timing header, the slow query log and query budgets.
+
+Responses carry a ``Server-Timing`` header with the phases ``metrics``
+times, the database phase with the number of queries, so browser dev tools
+and load tests show where a request spent its time. Statements slower than
+``SLOW_QUERY_SECONDS`` are logged to the ``casting.slow_queries`` logger
+with their plan from EXPLAIN (EXPLAIN QUERY PLAN on SQLite); a statement is
+explained at most once per ``SLOW_QUERY_EXPLAIN_INTERVAL`` so a burst of one
+slow query does not double the load. ``query_budget`` fails a test whose
+block runs more queries than allowed and names the statement it repeated
+most, the usual sign of N+1 queries.
+"""
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import current
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes')
+# seconds after which a statement is logged, -1 disables the log
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.25))
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 60))
+# EXPLAIN without ANALYZE, so the statement is planned and not run a second time
+EXPLAIN_PREFIXES = {'postgresql': 'EXPLAIN ', 'sqlite': 'EXPLAIN QUERY PLAN '}
+
+logger = logging.getLogger('casting.slow_queries')
+# statement -> monotonic time it was last explained, shared by the threads of a worker
+explained = {}
+explained_lock = threading.Lock()
+
+
+def server_timing(timer=None):
+    """The ``Server-Timing`` value of the current request, None outside one."""
+    timer = timer or current.get()
+    if timer is None: return None
+    entries = [f'{name};dur={seconds * 1000:.1f}' + (f';desc="queries: {timer.queries}"' if name == 'db' else '')
+               for name, seconds in timer.phases.items()]
+    entries.append(f'total;dur={(time.perf_counter() - timer.started) * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def explain(connection, statement, parameters):
+    """The plan of a SELECT as text, None for other statements and other databases.
+
+    On Postgres the EXPLAIN runs in a savepoint, since a failed statement
+    would abort the transaction of the request; its errors are only logged.
+    """
+    prefix = EXPLAIN_PREFIXES.get(connection.dialect.name)
+    if prefix is None or statement.split(None, 1)[0].upper() not in ('SELECT', 'WITH'): return None
+    savepoint = connection.dialect.name == 'postgresql'
+    # a DBAPI cursor of the same connection, so the plan sees the same transaction and no events fire
+    cursor = connection.connection.cursor()
+    try:
+        if savepoint: cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = '\n'.join(' '.join(str(value) for value in row) for row in cursor.fetchall())
+        except Exception as error:
+            if savepoint: cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            plan = f'EXPLAIN failed: {error}'
+        if savepoint: cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return plan
+    except Exception as error:
+        return f'EXPLAIN failed: {error}'
+    finally:
+        cursor.close()
+
+
+def due(statement):
+    """Whether the plan of a statement was not logged in the last SLOW_QUERY_EXPLAIN_INTERVAL."""
+    now = time.monotonic()
+    with explained_lock:
+        if now - explained.get(statement, now - SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL: return False
+        if len(explained) >= 1000: explained.clear()
+        explained[statement] = now
+    return True
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    # the start time is set by metrics.start_query
+    started = getattr(context, '_metrics_started', None)
+    if SLOW_QUERY_SECONDS < 0 or started is None: return
+    duration = time.perf_counter() - started
+    if duration < SLOW_QUERY_SECONDS: return
+    plan = explain(conn, statement, parameters) if SLOW_QUERY_EXPLAIN and not executemany and due(statement) else None
+    # parameters are left out, they hold user data
+    logger.warning('slow query, %.1f ms: %s%s', duration * 1000, statement, f'\n{plan}' if plan else '')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(limit, engine=Engine):
+    """Fail when the block runs more than ``limit`` queries, for tests of routes.
+
+        with query_budget(3):
+            client.get('/movies?include=cast', headers=headers)
+
+    Yields the list of the statements run so far.
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    if len(statements) > limit:
+        statement, repeats = Counter(statements).most_common(1)[0]
+        raise QueryBudgetExceeded(f'{len(statements)} queries over the budget of {limit}, '
+                                  f'{repeats} of them: {statement}')
@@ -0,0 +1,357 @@
+"""Request-independent pieces of the actor and movie endpoints.
+
+Shared by the WSGI app in ``app.py`` and the ASGI app in ``asgi.py``. The
+functions take the query arguments and the session explicitly and report
+invalid input with ``abort``.
+"""
+import io
+import os
+import csv
+import json
+import hashlib
+from datetime import date
+from werkzeug.exceptions import abort
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
+from compression import plain_etags
+from metrics import phase
+from models import parse_cursor
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder is used instead
+    orjson = None
+
+COUNT_PER_PAGE = 5
+MAX_PER_PAGE = int(os.environ.get('MAX_PER_PAGE', 100))
+# list arguments that are not field filters
+LIST_ARGS = {'page', 'per_page', 'after', 'sort', 'fields', 'include'}
+# alternative names of list filters
+FILTER_ALIASES = {
+    'released_from': 'release_date_min',
+    'released_to': 'release_date_max'
+}
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+SEARCH_LIMIT = int(os.environ.get('SEARCH_LIMIT', 10))
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+# seconds between the polls of a change stream for changes committed by other workers
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+# seconds a change stream stays open before the client reconnects with Last-Event-ID
+CHANGES_STREAM_SECONDS = float(os.environ.get('CHANGES_STREAM_SECONDS', 60))
+
+
+def json_default(o):
+    """Encode dates as ISO 8601 strings."""
+    if isinstance(o, date): return o.isoformat()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def dumps(payload):
+    """Encode a payload as compact JSON bytes with sorted keys, like ``jsonify``.
+
+    Uses orjson when it is installed, which also encodes dates itself.
+    """
+    with phase('serialize'):
+        if orjson is not None:
+            return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+        return (json.dumps(payload, default=json_default, separators=(',', ':'), sort_keys=True) + '\n').encode()
+
+
+def parse_value(model, name, value):
+    """Convert a request value to the Python type of the column, 400 if invalid."""
+    python_type = getattr(model, name).type.python_type
+    try:
+        if python_type is date: return date.fromisoformat(value)
+        return python_type(value)
+    except (TypeError, ValueError): abort(400)
+
+
+def list_query(model, args):
+    """Compile the filter, sort and fields arguments of a list request to SQL.
+
+    Returns the WHERE conditions, the ORDER BY clauses and the selected
+    field names. Unknown fields are rejected with 400 before any query runs.
+    """
+    names = ('id',) + model.fields
+    filters = {}
+    for name in names:
+        filters[name] = filters[f'{name}_min'] = filters[f'{name}_max'] = name
+    for alias, arg in FILTER_ALIASES.items():
+        if arg in filters: filters[alias] = arg
+    if not set(args) <= LIST_ARGS | set(filters): abort(400)
+
+    conditions = []
+    for arg, value in args.items():
+        if arg not in filters: continue
+        arg = FILTER_ALIASES.get(arg, arg)
+        column = getattr(model, filters[arg])
+        value = parse_value(model, filters[arg], value)
+        if arg.endswith('_min'): conditions.append(column >= value)
+        elif arg.endswith('_max'): conditions.append(column <= value)
+        else: conditions.append(column == value)
+
+    order = []
+    for key in args.get('sort', '').split(','):
+        if not key: continue
+        name = key.lstrip('-')
+        if name not in names: abort(400)
+        column = getattr(model, name)
+        order.append(column.desc() if key.startswith('-') else column.asc())
+    order.append(model.id)
+
+    if 'include' in args and args['include'] not in model.includes: abort(400)
+
+    fields = names
+    if 'fields' in args:
+        fields = tuple(args['fields'].split(','))
+        if not set(fields) <= set(names): abort(400)
+    return conditions, order, fields
+
+
+def paginate(session, model, args, conditions, order, fields):
+    """Return one page of rows and the next keyset cursor.
+
+    ``?after=<id>`` pages by primary key, so deep pages cost the same as the
+    first one. Otherwise ``?page=<n>`` uses LIMIT/OFFSET. Rows are dicts of
+    the selected fields. Only those columns are queried, as plain tuples
+    that bypass the ORM. With ``?include=`` the related rows of the whole
+    page are loaded by one more query.
+    """
+    per_page = args.get('per_page', COUNT_PER_PAGE, type=int)
+    if per_page < 1: abort(400)
+    per_page = min(per_page, MAX_PER_PAGE)
+    fields = tuple(dict.fromkeys(fields))
+    include = args.get('include')
+    if include:
+        stmt = select(model).options(include_option(model, include))
+    else:
+        table = model.__table__
+        names = fields if 'id' in fields else fields + ('id',)
+        stmt = select(*[table.c[name] for name in names])
+    stmt = stmt.where(*conditions).order_by(*order)
+
+    after = args.get('after', None)
+    if after is not None:
+        # keyset paging needs the rows ordered by id only
+        if len(order) > 1: abort(400)
+        stmt = stmt.where(model.id > parse_value(model, 'id', after)).limit(per_page + 1)
+    else:
+        page = args.get('page', 1, type=int)
+        if page < 1: abort(404)
+        stmt = stmt.offset(per_page * (page - 1)).limit(per_page + 1)
+    result = session.execute(stmt)
+    rows = result.scalars().all() if include else result.all()
+
+    # a cursor is only usable with the default id order
+    next_cursor = rows[per_page - 1].id if len(rows) > per_page and len(order) == 1 else None
+    if not include:
+        return [dict(zip(fields, row)) for row in rows[:per_page]], next_cursor
+    page = [{name: getattr(row, name) for name in fields} for row in rows[:per_page]]
+    for item, row in zip(page, rows): item[include] = related_rows(model, row, include)
+    return page, next_cursor
+
+
+def include_option(model, include):
+    """Loader option fetching the association rows and the rows they point to in one SELECT ... IN."""
+    relationship, target = model.includes[include]
+    association = getattr(model, relationship)
+    return selectinload(association).joinedload(getattr(association.property.mapper.class_, target))
+
+
+def related_rows(model, row, include):
+    relationship, target = model.includes[include]
+    return [dict(getattr(association, target).format(), role=association.role)
+            for association in getattr(row, relationship)]
+
+
+def related(session, model, id, include):
+    """The rows related to one entity, e.g. the cast of a movie, in two queries."""
+    row = session.query(model).options(include_option(model, include)).filter(model.id == id).one_or_none()
+    if row is None: abort(404)
+    return {
+        'success': True,
+        'id': row.id,
+        include: related_rows(model, row, include)
+    }
+
+
+def list_validators(session, model, conditions, query_string):
+    """Return the ETag and row count of a list without loading rows.
+
+    Lists have no Last-Modified: max(updated_at) stays put when a row is
+    deleted or leaves the filter, while the row count in the ETag moves.
+    """
+    last_modified, total = session.query(
+        func.max(model.updated_at), func.count(model.id)).filter(*conditions).one()
+    key = f'{model.__tablename__}:{total}:{last_modified}:{query_string}'
+    return hashlib.sha1(key.encode()).hexdigest(), total
+
+
+def list_payload(name, args, rows, next_cursor, total):
+    if len(rows) == 0: abort(404)
+    payload = {
+        'success': True,
+        name: rows,
+        'next_cursor': next_cursor
+    }
+    if 'after' not in args: payload[f'all_{name}'] = total
+    return payload
+
+
+def row_etag(model, row):
+    return version_etag(model, row.id, row.version)
+
+
+def version_etag(model, id, version):
+    return f'{model.__name__.lower()}-{id}-{version}'
+
+
+def match_versions(model, id, if_match):
+    """The row versions named by the strong ETags of If-Match, None without a precondition.
+
+    ``*`` only asks for the row to exist, which the write checks anyway.
+    """
+    if not if_match or if_match.star_tag: return None
+    prefix = version_etag(model, id, '')
+    return {int(tag[len(prefix):]) for tag in plain_etags(if_match).as_set()
+            if tag.startswith(prefix) and tag[len(prefix):].isdigit()}
+
+
+def validate_patch(model, req):
+    """The fields of a PATCH body as column values, other keys are ignored."""
+    if not isinstance(req, dict): abort(400)
+    if any(req.get(name, '') is None for name in model.fields): abort(400)
+    return {name: parse_value(model, name, req[name]) for name in model.fields if name in req}
+
+
+def is_fresh(if_none_match, if_modified_since, etag, last_modified):
+    """Whether the client's validators still match the current representation."""
+    if if_none_match:
+        return plain_etags(if_none_match).contains_weak(etag)
+    if if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def check_batch(items):
+    if not isinstance(items, list) or len(items) == 0: abort(400)
+    if len(items) > MAX_BATCH_SIZE: abort(413)
+    return items
+
+
+def validate_batch(model, items, partial=False):
+    """Reject the whole batch before touching the database if any item is invalid."""
+    allowed = set(model.fields)
+    if partial: allowed.add('id')
+    for item in check_batch(items):
+        if not isinstance(item, dict): abort(400)
+        if not set(item) <= allowed: abort(400)
+        if any(value is None for value in item.values()): abort(400)
+        if partial and type(item.get('id')) is not int: abort(400)
+        if not partial and len(item) != len(allowed): abort(400)
+        for name in model.fields:
+            if name in item: item[name] = parse_value(model, name, item[name])
+    return items
+
+
+def validate_ids(ids):
+    if any(type(id) is not int for id in check_batch(ids)): abort(400)
+    return ids
+
+
+def batch_results(ids, found):
+    return [{'id': id, 'success': True} if id in found
+            else {'id': id, 'success': False, 'error': 404}
+            for id in ids]
+
+
+def validate_cast(items):
+    """A cast is a list of ``{"actor_id", "role"}`` with each actor at most once."""
+    if not isinstance(items, list): abort(400)
+    if len(items) > MAX_BATCH_SIZE: abort(413)
+    for item in items:
+        if not isinstance(item, dict) or set(item) != {'actor_id', 'role'}: abort(400)
+        if type(item['actor_id']) is not int or not isinstance(item['role'], str) or not item['role']: abort(400)
+    if len({item['actor_id'] for item in items}) != len(items): abort(400)
+    return items
+
+
+def stats_payload(summary):
+    # each row is in one bucket of every dimension, so any dimension sums to the row count
+    return {
+        'success': True,
+        'total': sum(next(iter(summary.values())).values()),
+        'stats': summary
+    }
+
+
+def search_args(args):
+    q = args.get('q', '').strip()
+    if not q: abort(400)
+    limit = args.get('limit', SEARCH_LIMIT, type=int)
+    if limit < 1: abort(400)
+    return q, min(limit, MAX_PER_PAGE)
+
+
+def changes_args(args, last_event_id=None):
+    """The cursor and batch size of a change feed request, the cursor None without ``since``.
+
+    Streams resume from the ``Last-Event-ID`` header the browser sends when it reconnects.
+    """
+    since = last_event_id or args.get('since')
+    if since is not None and parse_cursor(since) is None: abort(400)
+    per_page = args.get('per_page', MAX_PER_PAGE, type=int)
+    if per_page < 1: abort(400)
+    return since, min(per_page, MAX_PER_PAGE)
+
+
+def changes_payload(feed):
+    if feed is None: abort(410)
+    changes, cursor, more = feed
+    return {
+        'success': True,
+        'changes': changes,
+        'cursor': cursor,
+        'more': more
+    }
+
+
+def change_event(change):
+    """A change as a Server-Sent Event whose id is its cursor."""
+    return f'id: {change["cursor"]}\nevent: change\ndata: {dumps(change).decode().rstrip()}\n\n'
+
+
+def export_query(model, args):
+    """Return the export format, the column names and the SELECT of an export."""
+    export_format = args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS: abort(400)
+    table = model.__table__
+    names = ('id',) + model.fields
+    return export_format, names, select(*[table.c[name] for name in names]).order_by(table.c.id)
+
+
+class ExportEncoder:
+    """Turn chunks of row tuples into NDJSON or CSV text."""
+
+    def __init__(self, export_format, names):
+        self.export_format = export_format
+        self.names = names
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def header(self):
+        if self.export_format != 'csv': return ''
+        return self.encode([self.names])
+
+    def encode(self, rows):
+        if self.export_format != 'csv':
+            return ''.join(json.dumps(dict(zip(self.names, row)), default=json_default) + '\n' for row in rows)
+        self.writer.writerows(rows)
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
@@ -0,0 +1,92 @@
+import re
+from sqlalchemy import DDL, event, func, literal_column, or_, select, text
+from models import db, Actor, Movie
+
+# the column matched by /<table>/search for each model
+SEARCH_COLUMNS = {
+    Actor: 'name',
+    Movie: 'title'
+}
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+LIKE_SPECIAL_RE = re.compile(r'([\\%_])')
+TS_CONFIG = literal_column("'simple'::regconfig")
+
+
+def sqlite_ddl(table, column):
+    """FTS5 index over the column, kept in sync by triggers on the table."""
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"
+    ]
+
+
+def postgresql_ddl(table, column):
+    """Full-text and trigram GIN indexes, maintained by Postgres itself."""
+    return [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_tsv ON {table} "
+        f"USING gin (to_tsvector('simple'::regconfig, {column}))",
+        f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)'
+    ]
+
+
+for model, column in SEARCH_COLUMNS.items():
+    table = model.__tablename__
+    for statement in sqlite_ddl(table, column):
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    for statement in postgresql_ddl(table, column):
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+    event.listen(model.__table__, 'after_drop',
+                 DDL(f'DROP TABLE IF EXISTS {table}_fts').execute_if(dialect='sqlite'))
+
+
+def prefix_pattern(q):
+    """LIKE pattern matching values that start with ``q``, with ``\\`` as escape."""
+    return LIKE_SPECIAL_RE.sub(r'\\\1', q) + '%'
+
+
+def search(model, q, limit, session=None):
+    """Return up to ``limit`` rows whose search column matches every term of
+    ``q`` as a word prefix, best matches first."""
+    session = session or db.session
+    terms = TERM_RE.findall(q)
+    if not terms: return []
+    table = model.__table__
+    column = table.c[SEARCH_COLUMNS[model]]
+    names = ('id',) + model.fields
+    dialect = session.connection().dialect.name
+
+    if dialect == 'sqlite':
+        fts = f'{table.name}_fts'
+        stmt = text(
+            f'SELECT {", ".join(f"{table.name}.{name}" for name in names)} '
+            f'FROM {fts} JOIN {table.name} ON {table.name}.id = {fts}.rowid '
+            f'WHERE {fts} MATCH :match ORDER BY bm25({fts}), {table.name}.id LIMIT :limit'
+        ).columns(*[table.c[name] for name in names])
+        params = {'match': ' '.join(f'"{term}"*' for term in terms), 'limit': limit}
+        rows = session.execute(stmt, params)
+    elif dialect == 'postgresql':
+        tsvector = func.to_tsvector(TS_CONFIG, column)
+        tsquery = func.to_tsquery(TS_CONFIG, ' & '.join(f'{term}:*' for term in terms))
+        rank = func.greatest(func.ts_rank(tsvector, tsquery), func.similarity(column, q))
+        rows = session.execute(
+            select(*[table.c[name] for name in names])
+            .where(or_(tsvector.op('@@')(tsquery), column.op('%')(q)))
+            .order_by(rank.desc(), table.c.id)
+            .limit(limit))
+    else:
+        rows = session.execute(
+            select(*[table.c[name] for name in names])
+            .where(column.ilike(prefix_pattern(q), escape='\\'))
+            .order_by(column, table.c.id)
+            .limit(limit))
+    return [dict(row._mapping) for row in rows]
@@ -0,0 +1,101 @@
+"""Coalescing of identical concurrent calls.
+
+While a call for a key runs, later callers with the same key wait for it
+and get its result, or its exception, instead of running it again. A
+caller that waits longer than ``SINGLEFLIGHT_TIMEOUT`` seconds runs the
+call itself. Calls are counted in ``singleflight_calls_total`` by outcome:
+``leader`` ran the call, ``coalesced`` shared the result of a running one
+and ``timeout`` gave up waiting.
+"""
+import os
+import asyncio
+import threading
+from metrics import registry
+
+SINGLEFLIGHT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_TIMEOUT', 5))
+
+
+def count(name, outcome):
+    registry.inc('singleflight_calls_total', (('name', name), ('outcome', outcome)))
+
+
+class Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces the calls of the threads of a process."""
+
+    def __init__(self, name, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader: flight = self._flights[key] = Flight()
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                count(self.name, 'timeout')
+                return fn()
+            count(self.name, 'coalesced')
+            if flight.error is not None: raise flight.error
+            return flight.result
+        count(self.name, 'leader')
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class AsyncSingleFlight:
+    """Coalesces the calls of the tasks of an event loop; ``fn`` returns an awaitable."""
+
+    def __init__(self, name, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._flights = {}
+
+    async def do(self, key, fn):
+        flight = self._flights.get(key)
+        if flight is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(flight), self.timeout)
+            except asyncio.CancelledError:
+                # only a cancelled leader is survived, not a cancelled waiter
+                if not flight.cancelled(): raise
+            except Exception:
+                pass
+            if flight.done() and not flight.cancelled():
+                count(self.name, 'coalesced')
+                return flight.result()
+            count(self.name, 'timeout')
+            return await fn()
+        count(self.name, 'leader')
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            flight.set_result(result)
+            return result
+        except Exception as error:
+            flight.set_exception(error)
+            # mark it retrieved, there may be no waiter to do it
+            flight.exception()
+            raise
+        finally:
+            del self._flights[key]
+            if not flight.done(): flight.cancel()
@@ -1,15 +1,44 @@
 import os
 import unittest
 import json
+import time
+import asyncio
+import tempfile
+import gzip
+import threading
+from datetime import date
+import rsa
+from jose.utils import long_to_base64
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import parse_etags
 from flask_sqlalchemy import SQLAlchemy
-from app import app
-from models import setup_db, Actor, Movie
+from app import app, cached, create_app, init_worker, replica_pins
+from sqlalchemy import create_engine, event, exc, inspect, select
+from models import db, setup_db, pool_stats, TimedQueuePool, Actor, Change, Movie, Stat
+import auth
+from auth import JWKSCache, TokenCache
+from cache import ReadCache, MemoryBackend, SharedBackend, LocalClient, read_cache
+from compression import add_vary, choose_encoding, compress_chunks, compressible, encoded_etag
+from limits import Admission, MemoryBuckets, Overloaded, RateLimiter, parse_limits
+from metrics import Registry, RequestTimer, LATENCY_BUCKETS, registry
+import profiling
+from profiling import QueryBudgetExceeded, query_budget, server_timing
+from resources import is_fresh, match_versions, paginate, related
+from search import prefix_pattern
+from singleflight import AsyncSingleFlight, SingleFlight
 from flask_migrate import Migrate
 from settings import *
 
 assistant_header = {'Authorization': f'Bearer {ASSISTANT_TOKEN}'}
 director_header = {'Authorization': f'Bearer {DIRECTOR_TOKEN}'}
 producer_header = {'Authorization': f'Bearer {PRODUCER_TOKEN}'}
+auth.METRICS_TOKEN = 'metrics-token'
+metrics_header = {'Authorization': 'Bearer metrics-token'}
+
+
+def counter(metric, **labels):
+    return registry.counters.get((metric, tuple(sorted(labels.items()))), 0)
 
 
 class CastingAgencyTestCase(unittest.TestCase):
@@ -104,6 +133,66 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['actors'][0]['gender'], self.new_actor['gender'])
         self.assertEqual(data['actors'][0]['age'], self.new_actor['age'])
         self.assertEqual(data['all_actors'], 1)
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_e1_get_actors_after_cursor(self):
+        res = self.client().get('/actors?after=0&per_page=1', headers=assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['next_cursor'], None)
+        self.assertNotIn('all_actors', data)
+
+    def test_e4_get_actors_filtered(self):
+        res = self.client().get('/actors?gender=male&age_min=18&sort=-age,name&fields=name', headers=assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'name': self.new_actor['name']}])
+        self.assertEqual(data['all_actors'], 1)
+
+    def test_e5_get_actors_unknown_field_400(self):
+        res = self.client().get('/actors?fields=salary', headers=assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # GET /actors/search
+
+    def test_e6_search_actors(self):
+        res = self.client().get('/actors/search?q=joh', headers=assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actors'][0]['name'], self.new_actor['name'])
+
+    def test_e7_search_actors_400(self):
+        res = self.client().get('/actors/search', headers=assistant_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    # GET /actors/export
+
+    def test_e2_export_actors(self):
+        res = self.client().get('/actors/export', headers=assistant_header)
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(rows[0]['name'], self.new_actor['name'])
+        self.assertEqual(len(rows), 1)
+
+    def test_e3_export_actors_csv(self):
+        res = self.client().get('/actors/export?format=csv', headers=assistant_header)
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,name,age,gender')
+        self.assertEqual(len(lines), 2)
 
     # GET /actors/<id>
 
@@ -126,6 +215,25 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['gender'], self.new_actor['gender'])
         self.assertEqual(data['name'], self.new_actor['name'])
 
+    def test_g1_get_actor_not_modified(self):
+        res = self.client().get('/actors/1', headers=assistant_header)
+        etag = res.headers['ETag']
+        res = self.client().get('/actors/1', headers={**assistant_header, 'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_g2_list_modified_by_delete(self):
+        actor_id = json.loads(self.client().post('/actors', headers=director_header, json=self.new_actor).data)['id']
+        res = self.client().get('/actors', headers=assistant_header)
+        self.assertNotIn('Last-Modified', res.headers)
+        self.client().delete(f'/actors/{actor_id}', headers=director_header)
+        res = self.client().get('/actors', headers={**assistant_header,
+                                                    'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+
+        self.assertEqual(res.status_code, 200)
+
     def test_h_get_actor_404(self):
         res = self.client().get('/actors/1000', headers=assistant_header)
         data = json.loads(res.data)
@@ -163,6 +271,16 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_k_patch_actors_412(self):
+        res = self.client().patch('/actors/1', headers=dict(director_header, **{'If-Match': '"actor-1-0"'}),
+                                  json=self.update_actor)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['error'], 412)
+        self.assertEqual(data['message'], 'precondition failed')
+
     # DELETE /actors
 
     def test_l_delete_actors_401(self):
@@ -242,6 +360,23 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['movies'][0]['title'], self.new_movie['title'])
         self.assertEqual(data['movies'][0]['release_date'], self.new_movie['release_date'])
         self.assertEqual(data['all_movies'], 1)
+        self.assertEqual(len(data['movies']), 1)
+
+    def test_s1_get_movies_released_range(self):
+        res = self.client().get('/movies?released_from=2024-12-31&released_to=2025-01-01', headers=assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['release_date'], self.new_movie['release_date'])
+
+        res = self.client().get('/movies?released_from=2025-01-02', headers=assistant_header)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_s2_get_movies_released_range_400(self):
+        res = self.client().get('/movies?released_from=yesterday', headers=assistant_header)
+
+        self.assertEqual(res.status_code, 400)
 
     # GET /movies/<id>
 
@@ -327,6 +462,848 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    # /actors/batch
+
+    def test_z4_post_actors_batch_400(self):
+        res = self.client().post('/actors/batch', headers=producer_header, json=[self.new_actor, {'name': 'No Age'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_z5_actors_batch(self):
+        res = self.client().post('/actors/batch', headers=producer_header, json=[self.new_actor, self.new_actor])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['ids']), 2)
+        ids = data['ids']
+
+        res = self.client().patch('/actors/batch', headers=director_header,
+                                  json=[{'id': ids[0], 'age': 90}, {'id': 1000, 'age': 90}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0], {'id': ids[0], 'success': True})
+        self.assertEqual(data['results'][1]['error'], 404)
+        self.assertEqual(Actor.query.get(ids[0]).age, 90)
+
+        res = self.client().delete('/actors/batch', headers=producer_header, json=ids)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(result['success'] for result in data['results']))
+        self.assertIsNone(Actor.query.get(ids[1]))
+
+
+    def test_z6_pool_status(self):
+        res = self.client().get('/internal/pool', headers=metrics_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['pool']['pool'], 'TimedQueuePool')
+        self.assertIn('checked_out', data['pool'])
+        self.assertIn('wait_seconds_total', data['pool'])
+
+    def test_z7_metrics(self):
+        self.client().get('/actors', headers=assistant_header)
+        res = self.client().get('/metrics', headers=metrics_header)
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_requests_total{method="GET",route="/actors",status="200"}', text)
+        self.assertIn('http_request_phase_seconds_count{method="GET",phase="db",route="/actors"}', text)
+        self.assertIn('db_queries_per_request_sum{method="GET",route="/actors"}', text)
+
+
+    def test_z8_query_budgets(self):
+        for path, budget in (('/movies?include=cast', 3), ('/actors/1/movies', 2), ('/actors/1', 1)):
+            with query_budget(budget):
+                res = self.client().get(path, headers=assistant_header)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('db;dur=', res.headers['Server-Timing'])
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Counters and histograms summed over worker snapshots."""
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Registry(directory=None)
+        registry.observe('http_request_duration_seconds', (('route', '/actors'),), 0.003, LATENCY_BUCKETS)
+        registry.observe('http_request_duration_seconds', (('route', '/actors'),), 20, LATENCY_BUCKETS)
+        text = registry.render()
+
+        self.assertIn('http_request_duration_seconds_bucket{route="/actors",le="0.005"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/actors",le="10"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/actors",le="+Inf"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{route="/actors"} 2', text)
+
+    def test_workers_aggregated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            labels = (('method', 'GET'), ('route', '/actors'), ('status', '200'))
+            worker = Registry(directory)
+            worker.inc('http_requests_total', labels, 3)
+            worker.flush(force=True)
+            os.rename(os.path.join(directory, f'{os.getpid()}.json'), os.path.join(directory, 'exited.json'))
+            registry = Registry(directory)
+            registry.inc('http_requests_total', labels, 2)
+
+            self.assertIn('http_requests_total{method="GET",route="/actors",status="200"} 5', registry.render())
+
+    def test_exited_worker_retired(self):
+        with tempfile.TemporaryDirectory() as directory:
+            labels = (('method', 'GET'), ('route', '/actors'), ('status', '200'))
+            for value in (3, 4):
+                worker = Registry(directory)
+                worker.inc('http_requests_total', labels, value)
+                worker.observe('http_request_duration_seconds', labels[:2], 0.003, LATENCY_BUCKETS)
+                worker.flush(force=True)
+                # the next worker gets the same pid
+                worker.retire(os.getpid())
+
+            self.assertEqual(os.listdir(directory), ['exited.json'])
+            text = Registry(directory).render()
+            self.assertIn('http_requests_total{method="GET",route="/actors",status="200"} 7', text)
+            self.assertIn('http_request_duration_seconds_count{method="GET",route="/actors"} 2', text)
+
+
+class PoolTestCase(unittest.TestCase):
+    """Checkout telemetry of the connection pool."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+                                    pool_timeout=0.01, pool_pre_ping=True)
+
+    def test_checkouts_and_timeouts_counted(self):
+        with self.engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                self.engine.connect()
+            stats = pool_stats(self.engine.pool)
+
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.01)
+
+    def test_stats_survive_dispose(self):
+        self.engine.connect().close()
+        self.engine.dispose()
+        self.engine.connect().close()
+        stats = pool_stats(self.engine.pool)
+
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['idle'], 1)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Base of the test cases that run each test on a new SQLite file."""
+    config = {}
+    create_tables = True
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.push(self.config)
+        if self.create_tables: db.create_all()
+
+    def push(self, config):
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}', **config})
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        os.remove(self.path)
+
+
+class AppFactoryTestCase(DatabaseTestCase):
+    """create_app builds an app without touching the database."""
+    config = {'TESTING': True}
+    create_tables = False
+
+    def test_no_schema_on_create(self):
+        self.assertTrue(self.app.testing)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        with self.app.app_context():
+            self.assertEqual(inspect(db.engine).get_table_names(), [])
+            db.create_all()
+            self.assertIn('actors', inspect(db.engine).get_table_names())
+
+    def test_worker_init_without_warmup(self):
+        init_worker(self.app, warmup=False)
+        res = self.app.test_client().get('/')
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_internals_need_metrics_token(self):
+        client = self.app.test_client()
+
+        self.assertEqual(client.get('/metrics').status_code, 401)
+        self.assertEqual(client.get('/internal/pool', headers=producer_header).status_code, 401)
+        self.assertEqual(client.get('/metrics', headers=metrics_header).status_code, 200)
+
+
+class CastTestCase(DatabaseTestCase):
+    """Casts are loaded with a constant number of queries."""
+
+    def setUp(self):
+        super().setUp()
+        actors = Actor.bulk_add([{'name': f'actor {i}', 'age': 30, 'gender': 'female'} for i in range(5)])
+        movies = Movie.bulk_add([{'title': f'movie {i}', 'release_date': date(2020, 1, 1)} for i in range(5)])
+        for movie_id in movies:
+            Movie.replace_cast(movie_id, [{'actor_id': id, 'role': f'role {id}'} for id in actors[:3]])
+        self.queries = 0
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        super().tearDown()
+
+    def count(self, *args):
+        self.queries += 1
+
+    def list_queries(self, per_page):
+        self.queries = 0
+        rows, _ = paginate(db.session, Movie, MultiDict({'include': 'cast', 'per_page': per_page}), [], [Movie.id],
+                           ('id', 'title'))
+        db.session.remove()
+        return rows, self.queries
+
+    def test_include_cast_constant_queries(self):
+        rows, one = self.list_queries(1)
+        rows, five = self.list_queries(5)
+
+        self.assertEqual(one, five)
+        self.assertEqual(five, 2)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([actor['role'] for actor in rows[4]['cast']], ['role 1', 'role 2', 'role 3'])
+
+    def test_malformed_cursor(self):
+        rows, _ = paginate(db.session, Movie, MultiDict({'after': '3'}), [], [Movie.id], ('id',))
+        self.assertEqual(rows, [{'id': 4}, {'id': 5}])
+        with self.assertRaises(BadRequest):
+            paginate(db.session, Movie, MultiDict({'after': 'abc'}), [], [Movie.id], ('id',))
+
+    def test_actor_movies(self):
+        payload = related(db.session, Actor, 2, 'movies')
+
+        self.assertEqual(self.queries, 2)
+        self.assertEqual(len(payload['movies']), 5)
+        self.assertEqual(payload['movies'][0]['role'], 'role 2')
+
+    def test_cast_removed_with_movie(self):
+        Movie.bulk_delete([1])
+
+        self.assertEqual(len(related(db.session, Actor, 1, 'movies')['movies']), 4)
+
+
+class StatsTestCase(DatabaseTestCase):
+    """The stored group counts follow every write path."""
+
+    def recount(self, model):
+        summary = {dimension: {} for dimension in model.dimensions}
+        for (dimension, bucket), count in Stat.group_counts(model, db.session.connection()).items():
+            summary[dimension][bucket] = count
+        return summary
+
+    def test_writes_update_stats(self):
+        Actor.bulk_add([{'name': f'actor {i}', 'age': 20 + i * 7, 'gender': 'female'} for i in range(6)])
+        Actor('John Doe', 41, 'male').add()
+        actor = Actor.query.get(1)
+        actor.age = 65
+        actor.update()
+        Actor.query.get(2).delete()
+        Actor.bulk_update([{'id': 3, 'gender': 'male'}, {'id': 4, 'age': 90}])
+        Actor.bulk_delete([5])
+        Movie.bulk_add([{'title': 'movie', 'release_date': date(1999, 1, 1)}])
+
+        self.assertEqual(Stat.summary(Actor), self.recount(Actor))
+        self.assertEqual(Stat.summary(Actor)['gender'], {'female': 3, 'male': 2})
+        self.assertEqual(Stat.summary(Movie), {'release_year': {'1999': 1}})
+
+    def test_interleaved_updates(self):
+        Actor.bulk_add([{'name': 'actor', 'age': 33, 'gender': 'female'}])
+        db.session.remove()
+        results = []
+
+        def update_in_thread():
+            with self.app.app_context():
+                results.append(Actor.update_one(1, {'gender': 'male'}))
+                db.session.remove()
+
+        second = threading.Thread(target=update_in_thread)
+
+        def interleave(conn, cursor, statement, parameters, context, executemany):
+            # the first update has read its old counts, the second one runs before it writes
+            if statement.startswith('UPDATE actors') and 'version' in statement and second.ident is None:
+                second.start()
+                second.join(0.5)
+
+        event.listen(db.engine, 'before_cursor_execute', interleave)
+        try:
+            results.append(Actor.update_one(1, {'gender': 'other'}))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', interleave)
+        second.join()
+
+        self.assertEqual(sorted(results), [2, 3])
+        self.assertEqual(Stat.summary(Actor)['gender'], {'male': 1})
+        self.assertEqual(Stat.summary(Actor), self.recount(Actor))
+
+    def test_rebuild(self):
+        Actor.bulk_add([{'name': 'actor', 'age': 33, 'gender': 'female'}])
+        db.session.execute(Stat.__table__.update().values(count=100))
+        db.session.commit()
+        Stat.rebuild((Actor, Movie))
+
+        self.assertEqual(Stat.summary(Actor), {'gender': {'female': 1}, 'age': {'30': 1}})
+
+
+class ProfilingTestCase(DatabaseTestCase):
+    """Query budgets, the slow query log and Server-Timing."""
+
+    def setUp(self):
+        super().setUp()
+        actors = Actor.bulk_add([{'name': f'actor {i}', 'age': 30, 'gender': 'female'} for i in range(3)])
+        for movie_id in Movie.bulk_add([{'title': f'movie {i}', 'release_date': date(2020, 1, 1)} for i in range(4)]):
+            Movie.replace_cast(movie_id, [{'actor_id': id, 'role': f'role {id}'} for id in actors])
+        db.session.remove()
+
+    def test_budget_catches_n_plus_one(self):
+        with query_budget(2) as statements:
+            related(db.session, Movie, 1, 'cast')
+        self.assertEqual(len(statements), 2)
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with query_budget(2):
+                for movie in Movie.query.all(): movie.cast
+
+        self.assertIn('5 queries over the budget of 2, 4 of them', str(raised.exception))
+        self.assertIn('FROM casts', str(raised.exception))
+
+    def test_slow_query_logged_with_plan(self):
+        threshold, profiling.SLOW_QUERY_SECONDS = profiling.SLOW_QUERY_SECONDS, 0
+        profiling.explained.clear()
+        try:
+            with self.assertLogs('casting.slow_queries') as logs:
+                db.session.execute(select(Actor.id).where(Actor.gender == 'female')).all()
+        finally:
+            profiling.SLOW_QUERY_SECONDS = threshold
+
+        self.assertIn('FROM actors', logs.output[0])
+        self.assertIn('ix_actors_gender_age', logs.output[0])
+
+    def test_failed_explain_keeps_transaction(self):
+        connection = db.session.connection()
+        Actor.query.get(1).age = 31
+        db.session.flush()
+
+        self.assertTrue(profiling.explain(connection, 'SELECT * FROM missing', ()).startswith('EXPLAIN failed'))
+        db.session.commit()
+        self.assertEqual(Actor.query.get(1).age, 31)
+
+    def test_server_timing(self):
+        timer = RequestTimer()
+        timer.phases['db'] = 0.0125
+        timer.queries = 3
+
+        self.assertIn('db;dur=12.5;desc="queries: 3"', server_timing(timer))
+        self.assertIsNone(server_timing())
+
+
+class SingleRowWriteTestCase(DatabaseTestCase):
+    """PATCH and DELETE of one row are a single statement guarded by the version."""
+
+    def setUp(self):
+        super().setUp()
+        Actor.bulk_add([{'name': f'actor {i}', 'age': 30, 'gender': 'female'} for i in range(2)])
+
+    def test_update_one(self):
+        self.assertEqual(Actor.update_one(1, {'gender': 'male'}, {1}), 2)
+        self.assertIs(Actor.update_one(1, {'name': 'lost update'}, {1}), False)
+        self.assertIsNone(Actor.update_one(3, {'name': 'missing'}))
+        self.assertEqual(Actor.query.get(1).name, 'actor 0')
+        self.assertEqual(Stat.summary(Actor)['gender'], {'female': 1, 'male': 1})
+
+    def test_update_one_without_values(self):
+        updated_at = Actor.query.get(2).updated_at
+        db.session.remove()
+
+        self.assertEqual(Actor.update_one(2, {}), 1)
+        self.assertIs(Actor.update_one(2, {}, {3}), False)
+        self.assertIsNone(Actor.update_one(3, {}))
+        self.assertEqual(Actor.query.get(2).updated_at, updated_at)
+        self.assertEqual(Change.head(), '0-2')
+
+    def test_delete_one(self):
+        self.assertIs(Actor.delete_one(1, {2}), False)
+        self.assertIs(Actor.delete_one(1, {1}), True)
+        self.assertIsNone(Actor.delete_one(1))
+        self.assertEqual(Stat.summary(Actor)['gender'], {'female': 1})
+        self.assertEqual(match_versions(Actor, 1, parse_etags('"actor-1-3", W/"actor-1-4", "movie-1-5"')), {3})
+
+
+class ChangeFeedTestCase(DatabaseTestCase):
+    """Every write path logs its rows for the change feeds."""
+
+    def test_writes_are_logged(self):
+        Actor.bulk_add([{'name': f'actor {i}', 'age': 30, 'gender': 'female'} for i in range(3)])
+        Actor('John Doe', 41, 'male').add()
+        Actor.update_one(1, {'age': 31})
+        Actor.bulk_delete([2])
+        Movie.bulk_add([{'title': 'movie', 'release_date': date(2020, 1, 1)}])
+        Movie.replace_cast(1, [{'actor_id': 1, 'role': 'lead'}])
+        changes, cursor, more = Change.feed(Actor, '0-0', 100)
+
+        self.assertEqual([(change['op'], change['id']) for change in changes],
+                         [('insert', 3), ('insert', 4), ('update', 1), ('delete', 2)])
+        self.assertEqual(changes[2]['row'], {'id': 1, 'name': 'actor 0', 'age': 31, 'gender': 'female'})
+        self.assertIsNone(changes[3]['row'])
+        self.assertEqual(cursor, '0-6')
+        self.assertFalse(more)
+        self.assertEqual([change['table'] for change in Change.feed(Movie, cursor, 100)[0]], ['movies', 'casts'])
+        self.assertEqual(Change.head(), '0-8')
+
+    def test_batches_continue_from_cursor(self):
+        Actor.bulk_add([{'name': f'actor {i}', 'age': 30, 'gender': 'female'} for i in range(5)])
+        first, cursor, more = Change.feed(Actor, '0-0', 3)
+        second, cursor, more_after = Change.feed(Actor, cursor, 3)
+
+        self.assertEqual([change['id'] for change in first + second], [1, 2, 3, 4, 5])
+        self.assertTrue(more)
+        self.assertFalse(more_after)
+        self.assertEqual(Change.feed(Actor, cursor, 3), ([], cursor, False))
+
+    def test_rolled_back_write_not_logged(self):
+        Movie.bulk_add([{'title': 'movie', 'release_date': date(2020, 1, 1)}])
+        with self.assertRaises(exc.IntegrityError):
+            Movie.bulk_add([{'title': 'movie', 'release_date': date(2021, 1, 1)}])
+
+        self.assertEqual(len(Change.feed(Movie, '0-0', 100)[0]), 1)
+
+    def test_prune_raises_watermark(self):
+        Actor.bulk_add([{'name': f'actor {i}', 'age': 30, 'gender': 'female'} for i in range(4)])
+
+        self.assertEqual(Change.prune(max_rows=2), 2)
+        self.assertIsNone(Change.feed(Actor, '0-1', 100))
+        self.assertEqual(len(Change.feed(Actor, '0-2', 100)[0]), 2)
+        self.assertEqual(Change.prune(retention=-1), 2)
+        self.assertEqual(Change.head(), '0-4')
+        self.assertEqual(Change.feed(Actor, '0-4', 100), ([], '0-4', False))
+        Actor.bulk_add([{'name': 'actor 4', 'age': 30, 'gender': 'female'}])
+        self.assertEqual([change['cursor'] for change in Change.feed(Actor, '0-4', 100)[0]], ['0-5'])
+
+    def test_gaps_are_not_pruned_changes(self):
+        Movie.bulk_add([{'title': f'movie {i}', 'release_date': date(2020, 1, 1)} for i in range(2)])
+        # the id a rolled back write took from the Postgres sequence
+        db.session.execute(Change.__table__.delete().where(Change.id == 1))
+        db.session.commit()
+
+        self.assertEqual(len(Change.feed(Movie, '0-0', 100)[0]), 1)
+
+
+class ReplicaTestCase(DatabaseTestCase):
+    """Read-only sessions go to a replica until they write."""
+
+    def setUp(self):
+        fd, self.replica_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.config = {'DATABASE_REPLICA_URLS': [f'sqlite:///{self.replica_path}']}
+        super().setUp()
+        replica = db.get_engine(bind='replica0')
+        db.Model.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Actor.__table__.insert(), {'name': 'replica', 'age': 30, 'gender': 'male'})
+        Actor.bulk_add([{'name': 'primary', 'age': 30, 'gender': 'female'}])
+
+    def tearDown(self):
+        super().tearDown()
+        os.remove(self.replica_path)
+
+    def names(self):
+        return [name for name, in db.session.query(Actor.name)]
+
+    def test_reads_from_replica_until_write(self):
+        self.assertEqual(self.names(), ['primary'])
+        db.session.remove()
+        db.session.info['read_only'] = True
+
+        self.assertEqual(self.names(), ['replica'])
+        Actor('new', 40, 'female').add()
+        self.assertTrue(db.session.info['pinned'])
+        self.assertEqual(self.names(), ['primary', 'new'])
+
+    def test_replica_load_not_cached_after_write(self):
+        Actor('new', 40, 'female').add()
+        key = read_cache.list_key('actors', 'replica-lag')
+
+        def fill():
+            db.session.remove()
+            db.session.info['read_only'] = True
+            with self.app.test_request_context('/actors'):
+                cached('actors', key, lambda: ('lagging', None, self.names))
+
+        fill()
+        self.assertIsNone(read_cache.get(key))
+        replica_pins.delete('table:actors')
+        fill()
+        self.assertEqual(json.loads(read_cache.get(key)[2]), ['replica'])
+
+    def test_failover_to_primary(self):
+        self.context.pop()
+        self.push({'DATABASE_REPLICA_URLS': ['sqlite:////nonexistent/replica.sqlite']})
+        replicas = self.app.extensions['replicas']
+        db.session.info['read_only'] = True
+
+        self.assertEqual(self.names(), ['primary'])
+        self.assertEqual(replicas.stats()['replica0'], {'reads': 0, 'failures': 1, 'up': False})
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This represents the in-process JWKS key store test case"""
+
+    def setUp(self):
+        public_key, _ = rsa.newkeys(512)
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': 'key-1',
+            'use': 'sig',
+            'n': long_to_base64(public_key.n).decode(),
+            'e': long_to_base64(public_key.e).decode()
+        }]}
+        self.fetches = 0
+        self.cache = JWKSCache('http://localhost/jwks.json', ttl=60, min_refresh_interval=60, name=self.id())
+        self.cache.fetch = self.fetch
+
+    def fetch(self):
+        self.fetches += 1
+        if isinstance(self.jwks, Exception): raise self.jwks
+        return self.jwks, None
+
+    def test_get_key_is_cached(self):
+        first = self.cache.get_key('key-1')
+        second = self.cache.get_key('key-1')
+
+        self.assertIsNotNone(first)
+        self.assertIs(first, second)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(counter('cache_events_total', cache=self.id(), event='hit'), 1)
+        self.assertEqual(counter('cache_events_total', cache=self.id(), event='miss'), 1)
+
+    def test_unknown_kid_refreshes_once(self):
+        self.cache.get_key('key-1')
+        self.cache._last_refresh -= 120
+        self.assertIsNone(self.cache.get_key('rotated'))
+        self.assertIsNone(self.cache.get_key('rotated'))
+
+        self.assertEqual(self.fetches, 2)
+
+    def test_stale_keys_served_when_refresh_fails(self):
+        key = self.cache.get_key('key-1')
+        self.cache._expires_at = 0
+        self.jwks = OSError('auth0 is down')
+
+        self.assertIs(self.cache.get_key('key-1'), key)
+        self.assertEqual(counter('cache_events_total', cache=self.id(), event='refresh_failure'), 1)
+
+    def test_concurrent_cold_start_fetches_once(self):
+        coalesced = counter('singleflight_calls_total', name='jwks', outcome='coalesced')
+        fetch = self.cache.fetch
+        self.cache.fetch = lambda: time.sleep(0.05) or fetch()
+        threads = [threading.Thread(target=self.cache.get_key, args=('key-1',)) for _ in range(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(counter('singleflight_calls_total', name='jwks', outcome='coalesced'), coalesced + 3)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This represents the verified-token cache test case"""
+
+    def payload(self, exp_in=60):
+        return {'sub': 'auth0|1', 'exp': time.time() + exp_in, 'permissions': frozenset(['get:actors'])}
+
+    def test_get_cached_payload(self):
+        cache = TokenCache(maxsize=2)
+        payload = self.payload()
+        cache.put('token', payload)
+
+        self.assertIs(cache.get('token'), payload)
+        self.assertIsNone(cache.get('other'))
+
+    def test_expired_payload_evicted(self):
+        cache = TokenCache(maxsize=2, name=self.id())
+        cache.put('token', self.payload(exp_in=-1))
+
+        self.assertIsNone(cache.get('token'))
+        self.assertFalse(cache._entries)
+        self.assertEqual(counter('cache_events_total', cache=self.id(), event='miss'), 1)
+
+    def test_size_cap_and_opt_out(self):
+        cache = TokenCache(maxsize=1, name=self.id())
+        cache.put('first', self.payload())
+        cache.put('second', self.payload())
+        disabled = TokenCache(maxsize=0)
+        disabled.put('first', self.payload())
+
+        self.assertIsNone(cache.get('first'))
+        self.assertIsNotNone(cache.get('second'))
+        self.assertIsNone(disabled.get('first'))
+        self.assertEqual(counter('cache_events_total', cache=self.id(), event='eviction'), 1)
+
+
+class LimitsTestCase(unittest.TestCase):
+    """This represents the rate limit and admission control test case"""
+
+    def payload(self, *permissions, sub='auth0|1'):
+        return {'sub': sub, 'permissions': frozenset(permissions)}
+
+    def test_bucket_per_subject_and_permission(self):
+        limiter = RateLimiter(MemoryBuckets(), parse_limits('assistant=1/2,producer=100'))
+        for _ in range(2): limiter.check('get:actors', self.payload('get:actors'))
+        with self.assertRaises(Overloaded) as raised:
+            limiter.check('get:actors', self.payload('get:actors'))
+        limiter.check('get:movies', self.payload('get:actors'))
+        limiter.check('get:actors', self.payload('get:actors', 'delete:movies', sub='auth0|2'))
+
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(raised.exception.retry_after, 1)
+
+    def test_bucket_refills(self):
+        buckets = MemoryBuckets()
+
+        self.assertEqual(buckets.take('key', 1000, 1), 0)
+        self.assertGreater(buckets.take('key', 1000, 1), 0)
+        time.sleep(0.002)
+        self.assertEqual(buckets.take('key', 1000, 1), 0)
+
+    def test_admission_sheds(self):
+        waiting = [0]
+        admission = Admission(max_in_flight=1, max_pool_waiting=2, pool_waiting=lambda: waiting[0])
+        with admission.admit():
+            with self.assertRaises(Overloaded):
+                with admission.admit(): pass
+        waiting[0] = 2
+        with self.assertRaises(Overloaded) as raised:
+            with admission.admit(): pass
+
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual(admission.in_flight, 0)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This represents the coalescing of concurrent identical calls test case"""
+
+    def run_threads(self, flight, fn, count=4):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', fn))) for _ in range(count)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return results
+
+    def test_concurrent_calls_share_one_run(self):
+        calls = []
+
+        def load():
+            calls.append(1)
+            time.sleep(0.05)
+            return len(calls)
+
+        self.assertEqual(self.run_threads(SingleFlight('test'), load), [1] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(SingleFlight('test').do('key', load), 2)
+
+    def test_error_reaches_waiters(self):
+        flight = SingleFlight('test')
+        errors = []
+
+        def fail():
+            time.sleep(0.05)
+            raise ValueError('database is down')
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except ValueError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(set(map(id, errors))), 1)
+
+    def test_waiter_runs_after_timeout(self):
+        calls = []
+
+        def load():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'loaded'
+
+        self.assertEqual(self.run_threads(SingleFlight('test', timeout=0.01), load, count=2), ['loaded'] * 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_async_calls_share_one_run(self):
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'loaded'
+
+        async def main():
+            flight = AsyncSingleFlight('test')
+            return await asyncio.gather(*[flight.do('key', load) for _ in range(4)])
+
+        self.assertEqual(asyncio.run(main()), ['loaded'] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_async_waiters_survive_cancelled_leader(self):
+        async def load():
+            await asyncio.sleep(0.05)
+            return 'loaded'
+
+        async def main():
+            flight = AsyncSingleFlight('test')
+            leader = asyncio.create_task(flight.do('key', load))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(flight.do('key', load))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await waiter
+
+        self.assertEqual(asyncio.run(main()), 'loaded')
+
+
+class CompressionTestCase(unittest.TestCase):
+    """This represents the response compression test case"""
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(choose_encoding('identity, gzip;q=0'))
+        self.assertIsNone(choose_encoding(None))
+
+    def test_streamed_chunks(self):
+        chunks = ['id,name\r\n', b'1,actor\r\n' * 1000]
+
+        self.assertEqual(gzip.decompress(b''.join(compress_chunks(chunks, 'gzip'))), b'id,name\r\n' + chunks[1])
+
+    def test_compressible_and_vary(self):
+        headers = Headers({'Content-Type': 'application/json', 'Vary': 'Origin'})
+        add_vary(headers)
+        add_vary(headers)
+
+        self.assertTrue(compressible(200, headers))
+        self.assertFalse(compressible(304, headers))
+        self.assertFalse(compressible(200, Headers({'Content-Type': 'image/png'})))
+        self.assertEqual(headers['Vary'], 'Origin, Accept-Encoding')
+
+    def test_encoded_etags_match(self):
+        etags = parse_etags(f'"{encoded_etag("actor-1-2", "gzip")}", W/"{encoded_etag("list", "br")}"')
+
+        self.assertEqual(match_versions(Actor, 1, etags), {2})
+        self.assertTrue(is_fresh(etags, None, 'actor-1-2', None))
+        self.assertTrue(is_fresh(etags, None, 'list', None))
+        self.assertFalse(is_fresh(etags, None, 'actor-1-3', None))
+
+
+class SearchTestCase(unittest.TestCase):
+    """The LIKE fallback of search matches a literal prefix."""
+
+    def test_wildcards_escaped(self):
+        engine = create_engine('sqlite://')
+        actors = Actor.__table__
+        actors.create(engine)
+        names = ['100% pure', '100 pure', 'a_b', 'axb', 'c\\d']
+        with engine.begin() as connection:
+            connection.execute(actors.insert(), [{'name': name, 'age': 30, 'gender': 'male'} for name in names])
+
+        def matches(q):
+            stmt = select(actors.c.name).where(actors.c.name.ilike(prefix_pattern(q), escape='\\')).order_by(actors.c.id)
+            with engine.connect() as connection:
+                return [name for name, in connection.execute(stmt)]
+
+        self.assertEqual(matches('100%'), ['100% pure'])
+        self.assertEqual(matches('a_'), ['a_b'])
+        self.assertEqual(matches('c\\'), ['c\\d'])
+        self.assertEqual(matches('A'), ['a_b', 'axb'])
+
+
+class ReadCacheTestCase(unittest.TestCase):
+    """This represents the GET result cache test case"""
+
+    def test_invalidate_entity_and_lists(self):
+        for backend in (MemoryBackend(), SharedBackend(LocalClient())):
+            cache = ReadCache(backend)
+            list_key = cache.list_key('actors', 'page=1')
+            cache.set('actors', list_key, 'list', cache.generation('actors'))
+            cache.set('actors', cache.entity_key('actors', 1), 'actor', cache.generation('actors'))
+
+            self.assertEqual(cache.get(list_key), 'list')
+            self.assertEqual(cache.get(cache.entity_key('actors', 1)), 'actor')
+
+            cache.invalidate([('actors', 'update', (1,))])
+
+            self.assertIsNone(cache.get(cache.entity_key('actors', 1)))
+            self.assertIsNone(cache.get(cache.list_key('actors', 'page=1')))
+
+    def test_events_exported(self):
+        cache = ReadCache(MemoryBackend(), name='exported')
+        cache.get(cache.entity_key('actors', 1))
+        cache.invalidate([('actors', 'delete', (1,))])
+        text = registry.render()
+
+        self.assertIn('cache_events_total{cache="exported",event="miss"} 1', text)
+        self.assertIn('cache_events_total{cache="exported",event="invalidation"} 1', text)
+
+    def test_stale_load_not_stored(self):
+        for backend in (MemoryBackend(), SharedBackend(LocalClient())):
+            cache = ReadCache(backend, name='stale')
+            hits = counter('cache_events_total', cache='stale', event='hit')
+            generation = cache.generation('movies')
+            cache.invalidate([('movies', 'delete', (1,))])
+            cache.set('movies', cache.entity_key('movies', 1), 'movie', generation)
+
+            self.assertIsNone(cache.get(cache.entity_key('movies', 1)))
+            self.assertEqual(counter('cache_events_total', cache='stale', event='hit'), hits)
+
+    def test_invalidate_while_storing(self):
+        client = LocalClient()
+        cache = ReadCache(SharedBackend(client))
+        invalidation = threading.Thread(target=cache.invalidate, args=([('movies', 'update', (1,))],))
+        get = client.get
+
+        def checked_generation(key):
+            # a write commits right after the store checked the generation
+            value = get(key)
+            if key.endswith('movies:generation') and invalidation.ident is None:
+                invalidation.start()
+                invalidation.join(0.2)
+            return value
+
+        generation = cache.generation('movies')
+        client.get = checked_generation
+        cache.set('movies', cache.entity_key('movies', 1), 'movie', generation)
+        invalidation.join()
+
+        self.assertIsNone(cache.get(cache.entity_key('movies', 1)))
+
+    def test_lru_size_and_ttl(self):
+        backend = MemoryBackend(maxsize=1, ttl=60)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.set('c', 3, ttl=-1)
+
+        self.assertIsNone(backend.get('a'))
+        self.assertIsNone(backend.get('c'))
+
 
 if __name__ == '__main__':
     unittest.main()
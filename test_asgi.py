@@ -0,0 +1,77 @@
+import json
+import asyncio
+import unittest
+import pytest
+
+# the ASGI app needs an async driver of the database, skip without one
+pytest.importorskip('aiosqlite')
+pytest.importorskip('sqlalchemy.dialects.sqlite.aiosqlite')
+
+import asgi  # noqa: E402
+from settings import ASSISTANT_TOKEN, DIRECTOR_TOKEN  # noqa: E402
+from test_app import DatabaseTestCase  # noqa: E402
+
+assistant_header = {'Authorization': f'Bearer {ASSISTANT_TOKEN}'}
+director_header = {'Authorization': f'Bearer {DIRECTOR_TOKEN}'}
+
+
+class AsgiTestCase(DatabaseTestCase):
+    """The ASGI app answers like the Flask app."""
+
+    def setUp(self):
+        super().setUp()
+        self.database_url = asgi.database_url
+        asgi.database_url = asgi.async_database_url(f'sqlite:///{self.path}')
+
+    def tearDown(self):
+        if asgi.engine is not None: asyncio.run(asgi.engine.dispose())
+        asgi.engine = None
+        asgi.database_url = self.database_url
+        super().tearDown()
+
+    def request(self, method, path, headers={}, query_string=''):
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode(),
+            'headers': [(key.lower().encode(), value.encode()) for key, value in headers.items()]
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(asgi.app(scope, receive, send))
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def test_async_database_url(self):
+        self.assertEqual(asgi.async_database_url('postgresql://u:p@host/db').drivername, 'postgresql+asyncpg')
+        self.assertEqual(asgi.async_database_url('sqlite:///database.sqlite').drivername, 'sqlite+aiosqlite')
+
+    def test_same_list_as_flask(self):
+        status, body = self.request('GET', '/actors', assistant_header, 'fields=name')
+        res = self.app.test_client().get('/actors?fields=name', headers=assistant_header)
+
+        self.assertEqual(status, res.status_code)
+        self.assertEqual(json.loads(body), res.json)
+
+    def test_same_error_json_as_flask(self):
+        status, body = self.request('DELETE', '/movies/1', director_header)
+        res = self.app.test_client().delete('/movies/1', headers=director_header)
+
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body), res.json)
+
+    def test_unknown_route(self):
+        status, body = self.request('GET', '/directors', assistant_header)
+
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['message'], 'not found')
+
+
+if __name__ == '__main__':
+    unittest.main()